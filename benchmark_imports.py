@@ -0,0 +1,40 @@
+import subprocess
+import sys
+
+# modules imported at start up by main.py, followed by the heavy dependencies which should only be imported on use
+MODULES = ['helpers.config', 'helpers.prompt', 'helpers.util', 'helpers.inactive_ingredients_data',
+           'helpers.get_spl_data', 'helpers.schemas', 'helpers.extraction', 'helpers.parallel',
+           'openai', 'langchain', 'llama_index']
+
+
+def import_time(module, repeat=3):
+    """ Measure the cold import time of a module (in a new interpreter each time, so nothing is cached)
+
+    Parameters
+    ----------
+    module : str
+        module name to import
+    repeat : int
+        number of measures, the best one is returned
+
+    Returns
+    -------
+    duration : float
+        import time in seconds (or None if the module can't be imported)
+    """
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+
+    durations = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        durations.append(float(result.stdout.strip().split('\n')[-1]))
+
+    return min(durations)
+
+
+if __name__ == '__main__':
+    for module in MODULES:
+        duration = import_time(module)
+        print(f"{module:<40} {'error' if duration is None else f'{duration * 1000:.0f} ms'}")
@@ -0,0 +1,44 @@
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding
+from helpers.embedding_batcher import get_embedding_batcher
+
+
+class BatchedEmbedding(BaseEmbedding):
+    """ Embedding model of the indexes sending its texts through the run-level EmbeddingBatcher
+    (see helpers.embedding_batcher)
+    """
+
+    _batcher = PrivateAttr()
+
+    def __init__(self, batcher, **kwargs):
+        # a whole label is handed to the batcher at once, the batcher splits the requests
+        super().__init__(embed_batch_size=2048, **kwargs)
+        self._batcher = batcher
+
+    def _get_query_embedding(self, query):
+        return self._batcher.embed_query(query)
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text):
+        return self._batcher.embed([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        return self._batcher.embed(texts)
+
+
+def batched_embed_model(embed_model):
+    """ Embedding model going through the batcher of the run
+
+    Parameters
+    ----------
+    embed_model : llama_index.embeddings.base.BaseEmbedding
+        embedding model of the endpoint (None for the default OpenAI one)
+
+    Returns
+    -------
+    BatchedEmbedding
+        embedding model to use in the service context
+    """
+    return BatchedEmbedding(get_embedding_batcher(embed_model))
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+import numpy as np
+
+NUM_PERMUTATIONS = 64
+LSH_BANDS = 16
+SHINGLE_WORDS = 5
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_rng = np.random.RandomState(42)
+_PERM_A = _rng.randint(1, 2 ** 31, NUM_PERMUTATIONS).astype(np.uint64)
+_PERM_B = _rng.randint(0, 2 ** 31, NUM_PERMUTATIONS).astype(np.uint64)
+
+# LLM answers per chunk of context: (hash of the query, context, schema and model): answer
+_ANSWER_CACHE = OrderedDict()
+_ANSWER_CACHE_LOCK = threading.Lock()
+
+
+def minhash_signature(txt):
+    """ MinHash signature of the word shingles of a text (chunks sharing most of their shingles have most of their
+    signature in common)
+
+    Parameters
+    ----------
+    txt : str
+        text of the chunk
+
+    Returns
+    -------
+    numpy.ndarray
+        NUM_PERMUTATIONS min hashes, or None when the text is shorter than a shingle
+    """
+    words = re.findall(r"[a-z0-9]+", txt.lower())
+    if len(words) < SHINGLE_WORDS:
+        return None
+
+    shingles = set([" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)])
+    hashes = np.fromiter((zlib.crc32(s.encode()) for s in shingles), dtype=np.uint64, count=len(shingles))
+
+    return ((_PERM_A[:, None] * hashes[None, :] + _PERM_B[:, None]) % _MERSENNE_PRIME).min(axis=1)
+
+
+class NearDuplicateIndex:
+    """ Locality sensitive hashing (LSH bands) of MinHash signatures, to find a chunk already seen whose estimated
+    Jaccard similarity is above the threshold
+    """
+
+    def __init__(self, threshold=0.9, bands=LSH_BANDS):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = NUM_PERMUTATIONS // bands
+        self._buckets = {}
+        self._signatures = {}
+
+    def _band_keys(self, signature):
+        return [(b, signature[b * self.rows:(b + 1) * self.rows].tobytes()) for b in range(self.bands)]
+
+    def find(self, signature):
+        """ Key of a near duplicate of the signature (None if there is none)
+        """
+        for band_key in self._band_keys(signature):
+            for key in self._buckets.get(band_key, []):
+                if np.mean(self._signatures[key] == signature) >= self.threshold:
+                    return key
+
+        return None
+
+    def add(self, key, signature):
+        self._signatures[key] = signature
+        for band_key in self._band_keys(signature):
+            self._buckets.setdefault(band_key, []).append(key)
+
+    def remove(self, key):
+        signature = self._signatures.pop(key, None)
+        if signature is None:
+            return
+        for band_key in self._band_keys(signature):
+            bucket = self._buckets.get(band_key, [])
+            if key in bucket:
+                bucket.remove(key)
+            if len(bucket) == 0:
+                self._buckets.pop(band_key, None)
+
+
+def cached_chunk_answer(fn, context, query, json_schema, model):
+    """ Answer of the LLM for one chunk of context, reused across labels when the exact same chunk is asked the same
+    question with the same schema and model (CHUNK_ANSWER_CACHE, default 'True'). Near duplicates are not reused, a
+    small difference in the text may change the answer
+
+    Parameters
+    ----------
+    fn : callable
+        function called with (context, query) returning the answer
+    context : str
+        chunk (or chunks) of the label sent as context
+    query : str
+        question asked
+    json_schema : dict
+        schema of the answer
+    model : str
+        model (deployment) answering
+
+    Returns
+    -------
+    answer of fn
+    """
+    if os.environ.get('CHUNK_ANSWER_CACHE', 'True') != 'True':
+        return fn(context, query)
+
+    import json
+
+    key = hashlib.sha256("\0".join([model, json.dumps(json_schema, sort_keys=True), query, context]).encode())
+    key = key.hexdigest()
+    with _ANSWER_CACHE_LOCK:
+        if key in _ANSWER_CACHE:
+            _ANSWER_CACHE.move_to_end(key)
+            return json.loads(_ANSWER_CACHE[key])
+
+    answer = fn(context, query)
+    with _ANSWER_CACHE_LOCK:
+        _ANSWER_CACHE[key] = json.dumps(answer)
+        while len(_ANSWER_CACHE) > int(os.environ.get('CHUNK_ANSWER_CACHE_SIZE', '10000')):
+            _ANSWER_CACHE.popitem(last=False)
+
+    return answer
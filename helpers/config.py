@@ -1,20 +1,64 @@
 from dotenv import load_dotenv
-import openai
+from functools import lru_cache
 import os
 
 # load environment variables configuration which will be used through application
 load_dotenv("config/azure_canada_example.env")
 
-if 'AZURE_API' in os.environ and os.environ['AZURE_API'] != '':
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-    openai.api_type = "azure"
-    openai.api_base = os.getenv("OPENAI_API_BASE")
-    openai.api_version = os.getenv("OPENAI_API_VERSION")
-    os.environ["OPENAI_API_BASE"] = os.getenv("OPENAI_API_BASE")
-    os.environ["OPENAI_API_VERSION"] = os.getenv("OPENAI_API_VERSION")
-    os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
-else:
-    openai.api_key = os.getenv("OPENAI_API_KEY")
+
+@lru_cache(maxsize=None)
+def configure_openai():
+    """ Configure the openai module (imported only when a model is going to be used, since importing it is slow)
+
+    Returns
+    -------
+    None
+    """
+    import openai
+
+    if 'AZURE_API' in os.environ and os.environ['AZURE_API'] != '':
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+        openai.api_type = "azure"
+        openai.api_base = os.getenv("OPENAI_API_BASE")
+        openai.api_version = os.getenv("OPENAI_API_VERSION")
+        os.environ["OPENAI_API_BASE"] = os.getenv("OPENAI_API_BASE")
+        os.environ["OPENAI_API_VERSION"] = os.getenv("OPENAI_API_VERSION")
+        os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
+    else:
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+
+
+@lru_cache(maxsize=None)
+def local_embed_model():
+    """ Local embedding model configured through LOCAL_EMBEDDINGS_MODEL (a sentence-transformers model of HuggingFace,
+    ex: 'BAAI/bge-small-en-v1.5'), run in process on CPU with batched inference. With LOCAL_EMBEDDINGS_ONNX=True the
+    model is exported once to ONNX (data/onnx/) and run with optimum. Loaded once per process
+
+    Returns
+    -------
+    llama_index.embeddings.base.BaseEmbedding
+        the embedding model, or None when LOCAL_EMBEDDINGS_MODEL isn't set
+    """
+    model_name = os.environ.get('LOCAL_EMBEDDINGS_MODEL', '')
+    if model_name == '':
+        return None
+
+    batch_size = int(os.environ.get('LOCAL_EMBEDDINGS_BATCH', '32'))
+    if os.environ.get('LOCAL_EMBEDDINGS_ONNX', 'False') == 'True':
+        from llama_index.embeddings import OptimumEmbedding
+
+        folder_name = os.path.join("data/onnx", model_name.replace('/', '_'))
+        if not os.path.isdir(folder_name):
+            OptimumEmbedding.create_and_save_optimum_model(model_name, folder_name)
+        return OptimumEmbedding(folder_name=folder_name, embed_batch_size=batch_size)
+
+    from llama_index.embeddings import HuggingFaceEmbedding
+
+    return HuggingFaceEmbedding(model_name=model_name, device='cpu', embed_batch_size=batch_size)
+
+
+# nodes retrieved per query by the vector and hybrid indexes (llama_index default similarity_top_k)
+DEFAULT_TOP_K = 2
 
 TYPE_OF_OUTPUT = 'normal' if 'TYPE_OF_OUTPUT' not in os.environ or os.environ['TYPE_OF_OUTPUT'] != 'simple' else 'simple'
 SELECTED_GROUPS = list(map(int, os.environ['SELECTED_GROUPS'].split(",")))
@@ -0,0 +1,192 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import numpy as np
+from helpers.chunk_dedup import minhash_signature, NearDuplicateIndex
+from helpers.index_store import embedding_name
+from helpers.rate_limit import get_scheduler, estimate_tokens, PRIORITY_EMBEDDINGS
+
+# one batcher per embedding model for the whole run: (embedding name): EmbeddingBatcher
+_BATCHERS = {}
+_BATCHERS_LOCK = threading.Lock()
+
+
+class EmbeddingBatcher:
+    """ Run-level embedding batcher: the chunks of all the labels being indexed at the same time are coalesced into
+    requests of up to max_batch inputs, and identical chunks (boilerplate sections repeat across generics) are embedded
+    once. With a near duplicate threshold, chunks whose MinHash similarity with a chunk already embedded is above it
+    reuse its embedding. A request is sent as soon as max_batch chunks are waiting, or after max_wait seconds
+    otherwise. The thread sending a request also sends whatever the other threads queued meanwhile.
+    """
+
+    def __init__(self, embed_fn, query_fn, max_batch=16, max_wait=0.05, cache_size=20000,
+                 deployment_env_key="OPENAI_EMBEDDINGS_DEPLOYMENT", near_duplicate_threshold=0):
+        self.embed_fn = embed_fn
+        self.query_fn = query_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+        self.deployment_env_key = deployment_env_key
+        self._lock = threading.Lock()
+        self._futures = OrderedDict()
+        self._pending = []
+        self._timer = None
+        self._near = NearDuplicateIndex(near_duplicate_threshold) if near_duplicate_threshold > 0 else None
+        self._metrics = {'requests': 0, 'embedded': 0, 'deduplicated': 0, 'near_duplicates': 0}
+
+    def _future(self, key, signature=None):
+        """ Future of the embedding of a text and whether it must be requested (False when the text, or a near
+        duplicate of it, was already requested during the run), must be called with the lock held
+        """
+        future = self._futures.get(key)
+        if future is not None:
+            self._futures.move_to_end(key)
+            self._metrics['deduplicated'] += 1
+            return future, False
+
+        near_key = self._near.find(signature) if self._near is not None and signature is not None else None
+        if near_key is not None and near_key in self._futures:
+            future, new = self._futures[near_key], False
+            self._metrics['near_duplicates'] += 1
+        else:
+            future, new = Future(), True
+            if self._near is not None and signature is not None:
+                self._near.add(key, signature)
+        self._futures[key] = future
+
+        # least recently used embeddings are dropped, the ones still being requested are kept
+        while len(self._futures) > self.cache_size and next(iter(self._futures.values())).done():
+            old_key, _ = self._futures.popitem(last=False)
+            if self._near is not None:
+                self._near.remove(old_key)
+
+        return future, new
+
+    def embed(self, texts):
+        """ Embeddings of texts (chunks of a document), in the same order
+        """
+        keys = ['t' + hashlib.sha1(txt.encode()).hexdigest() for txt in texts]
+        # signatures are computed outside of the lock, the other threads keep queuing meanwhile
+        if self._near is not None:
+            with self._lock:
+                known = set([k for k in keys if k in self._futures])
+            signatures = [minhash_signature(txt) if k not in known else None for k, txt in zip(keys, texts)]
+        else:
+            signatures = [None] * len(texts)
+
+        futures = []
+        with self._lock:
+            for key, txt, signature in zip(keys, texts, signatures):
+                future, new = self._future(key, signature)
+                if new:
+                    self._pending.append((key, txt, future))
+                futures.append(future)
+
+            full = len(self._pending) >= self.max_batch
+            if not full and len(self._pending) > 0 and self._timer is None:
+                self._timer = threading.Timer(self.max_wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        if full:
+            self.flush()
+
+        return [f.result().tolist() for f in futures]
+
+    def embed_query(self, query):
+        """ Embedding of a query, the same prompts are asked for every label so it is computed once per run
+        """
+        key = 'q' + hashlib.sha1(query.encode()).hexdigest()
+        with self._lock:
+            future, new = self._future(key)
+
+        if new:
+            self._request([(key, query, future)], lambda texts: [self.query_fn(texts[0])])
+
+        return future.result().tolist()
+
+    def flush(self):
+        """ Send the queued texts, in requests of up to max_batch texts
+        """
+        while True:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            if len(batch) == 0:
+                return
+            self._request(batch, self.embed_fn)
+
+    def _request(self, batch, fn):
+        texts = [txt for _, txt, _ in batch]
+        try:
+            embeddings = get_scheduler().call(self.deployment_env_key, fn, texts,
+                                              prompt_tokens=sum([estimate_tokens(t) for t in texts]), output_tokens=0,
+                                              priority=PRIORITY_EMBEDDINGS)
+        except Exception as e:
+            # failed texts are not memoized, the next request will try again
+            failed = set([id(future) for _, _, future in batch])
+            with self._lock:
+                # including the near duplicates waiting on the same futures
+                for key in [k for k, f in self._futures.items() if id(f) in failed]:
+                    self._futures.pop(key)
+                    if self._near is not None:
+                        self._near.remove(key)
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        with self._lock:
+            self._metrics['requests'] += 1
+            self._metrics['embedded'] += len(batch)
+        for (_, _, future), embedding in zip(batch, embeddings):
+            future.set_result(np.asarray(embedding, dtype=np.float32))
+
+    def metrics(self):
+        """ Requests sent, texts embedded, texts deduplicated and near duplicates (served from the batcher) so far
+        """
+        with self._lock:
+            return dict(self._metrics)
+
+
+def get_embedding_batcher(embed_model):
+    """ Batcher of the run for the embedding model, created with the first embedding model given for its embedding
+    name (see helpers.index_store.embedding_name)
+
+    Parameters
+    ----------
+    embed_model : llama_index.embeddings.base.BaseEmbedding
+        embedding model of the endpoint (None for the default OpenAI one)
+
+    Returns
+    -------
+    EmbeddingBatcher
+        the batcher
+    """
+    name = embedding_name()
+    with _BATCHERS_LOCK:
+        if name not in _BATCHERS:
+            if embed_model is None:
+                from llama_index import OpenAIEmbedding
+
+                embed_model = OpenAIEmbedding()
+            # Azure deployments accept 16 inputs per request
+            max_batch = int(os.environ.get('EMBEDDING_BATCH_SIZE', '16' if os.environ.get('AZURE_API', '') != ''
+                                           else '2048'))
+            _BATCHERS[name] = EmbeddingBatcher(embed_model._get_text_embeddings, embed_model._get_query_embedding,
+                                               max_batch=max_batch,
+                                               max_wait=float(os.environ.get('EMBEDDING_BATCH_WAIT_MS', '50')) / 1000,
+                                               near_duplicate_threshold=float(
+                                                   os.environ.get('EMBEDDING_NEAR_DUPLICATE', '0.9')))
+
+        return _BATCHERS[name]
+
+
+def batcher_metrics():
+    """ Metrics of the batchers of the run: (embedding name): (requests, embedded, deduplicated, near_duplicates)
+    """
+    with _BATCHERS_LOCK:
+        return {name: batcher.metrics() for name, batcher in _BATCHERS.items()}
@@ -0,0 +1,214 @@
+import numpy as np
+import pandas as pd
+from helpers.inactive_ingredients_data import read_reference_csv, DEFAULT_INACTIVE_CSV
+from helpers.ndc_store import lookup_truth
+
+
+def build_matrices(records, ri_ids):
+    """ Boolean matrices (items x Reported Inactive IDs) of the true and found ingredients of a run
+
+    Parameters
+    ----------
+    records : list
+        one dictionary per item with keys: search, true_ids, found_ids
+    ri_ids : numpy.ndarray
+        Reported Inactive IDs, in the order of the columns
+
+    Returns
+    -------
+    truth : numpy.ndarray
+        truth[i, j] is True when the item i has the ingredient ri_ids[j] (Todd's rules)
+    found : numpy.ndarray
+        found[i, j] is True when the ingredient ri_ids[j] was found in the item i
+    """
+    column = {ri_id: j for j, ri_id in enumerate(ri_ids)}
+    truth = np.zeros((len(records), len(ri_ids)), dtype=bool)
+    found = np.zeros((len(records), len(ri_ids)), dtype=bool)
+
+    for i, record in enumerate(records):
+        truth[i, [column[k] for k in record['true_ids'] if k in column]] = True
+        found[i, [column[k] for k in record['found_ids'] if k in column]] = True
+
+    return truth, found
+
+
+def truth_from_store(store, records, ri_ids, ndc_setid):
+    """ True ingredients matrix of a run read from the precomputed bitset matrix of the NDC store (one lookup for the
+    whole run, the group filter being a column mask)
+
+    Parameters
+    ----------
+    store : dict
+        store loaded with load_ndc_store (see helpers.ndc_store.build_ndc_store)
+    records : list
+        one dictionary per item with keys: setid, ndc11
+    ri_ids : numpy.ndarray
+        Reported Inactive IDs, in the order of the columns
+    ndc_setid : str
+        Whether the extraction is occuring at SETID level or NDC (value: 'ndc' or 'setid')
+
+    Returns
+    -------
+    truth : numpy.ndarray
+        truth[i, j] is True when the item i has the ingredient ri_ids[j] (Todd's rules)
+    """
+    keys = [r['setid'] if ndc_setid == 'setid' else r['ndc11'] for r in records]
+    truth, store_ri_ids = lookup_truth(store, keys, ndc_setid)
+
+    columns = np.searchsorted(store_ri_ids, ri_ids)
+    known = (columns < len(store_ri_ids)) & (store_ri_ids[np.minimum(columns, len(store_ri_ids) - 1)] == ri_ids)
+    result = np.zeros((len(records), len(ri_ids)), dtype=bool)
+    result[:, known] = truth[:, columns[known]]
+
+    return result
+
+
+def group_metrics(truth, found, groups):
+    """ Metrics of each group of ingredients over the whole run: accuracy (items with exactly the right ingredients of
+    the group), True Positive Rate (true ingredients found) and False Positive Rate (items without any ingredient of
+    the group where one was found)
+
+    Parameters
+    ----------
+    truth : numpy.ndarray
+        true ingredients matrix (see build_matrices)
+    found : numpy.ndarray
+        found ingredients matrix (see build_matrices)
+    groups : numpy.ndarray
+        group number of each column
+
+    Returns
+    -------
+    pandas.DataFrame
+        one row per group with: Group, tested, accuracy, errors, tp, positives, tpr, fp, negatives, fpr
+    """
+    rows = []
+    for group in np.unique(groups):
+        mask = groups == group
+        t, f = truth[:, mask], found[:, mask]
+
+        errors = int((t != f).any(axis=1).sum())
+        tp, positives = int((t & f).sum()), int(t.sum())
+        negative_items = ~t.any(axis=1)
+        fp, negatives = int(f[negative_items].any(axis=1).sum()), int(negative_items.sum())
+
+        rows.append({'Group': int(group), 'tested': t.shape[0], 'errors': errors,
+                     'accuracy': 1 - errors / t.shape[0] if t.shape[0] > 0 else np.nan,
+                     'tp': tp, 'positives': positives, 'tpr': tp / positives if positives > 0 else np.nan,
+                     'fp': fp, 'negatives': negatives, 'fpr': fp / negatives if negatives > 0 else np.nan})
+
+    return pd.DataFrame(rows)
+
+
+def confusion(truth, found, ri_ids):
+    """ Confusion matrix of each ingredient over the whole run
+
+    Parameters
+    ----------
+    truth : numpy.ndarray
+        true ingredients matrix (see build_matrices)
+    found : numpy.ndarray
+        found ingredients matrix (see build_matrices)
+    ri_ids : numpy.ndarray
+        Reported Inactive IDs, in the order of the columns
+
+    Returns
+    -------
+    pandas.DataFrame
+        one row per ingredient with: ReportedInactiveID, tp, fn, fp, tn
+    """
+    return pd.DataFrame({'ReportedInactiveID': ri_ids,
+                         'tp': (truth & found).sum(axis=0), 'fn': (truth & ~found).sum(axis=0),
+                         'fp': (~truth & found).sum(axis=0), 'tn': (~truth & ~found).sum(axis=0)})
+
+
+def error_breakdown(records, truth, found, ri_ids, groups):
+    """ Missing and extra ingredients (and their groups) of each item with errors
+
+    Parameters
+    ----------
+    records : list
+        one dictionary per item with keys: search, true_ids, found_ids
+    truth : numpy.ndarray
+        true ingredients matrix (see build_matrices)
+    found : numpy.ndarray
+        found ingredients matrix (see build_matrices)
+    ri_ids : numpy.ndarray
+        Reported Inactive IDs, in the order of the columns
+    groups : numpy.ndarray
+        group number of each column
+
+    Returns
+    -------
+    pandas.DataFrame
+        one row per item with errors with: search, missing, group_missing, too_much, group_toomuch
+    """
+    missing, too_much = truth & ~found, ~truth & found
+    rows = []
+    for i in np.flatnonzero((missing | too_much).any(axis=1)):
+        rows.append({'search': records[i]['search'],
+                     'missing': ri_ids[missing[i]].tolist(), 'group_missing': groups[missing[i]].tolist(),
+                     'too_much': ri_ids[too_much[i]].tolist(), 'group_toomuch': groups[too_much[i]].tolist()})
+
+    return pd.DataFrame(rows, columns=['search', 'missing', 'group_missing', 'too_much', 'group_toomuch'])
+
+
+def evaluate(records, config=DEFAULT_INACTIVE_CSV, filter_group=None, store=None, ndc_setid='setid'):
+    """ Evaluate a whole run against Todd's rules at once (replaces parsing the compare_results messages)
+
+    Parameters
+    ----------
+    records : list
+        one dictionary per item with keys: search, setid, ndc11, true_ids (see get_todd_ingredients), found_ids
+    config : str
+        path to the configuration file of Reported Inactive Ingredients (ID and group)
+    filter_group : list
+        groups to evaluate (None for all)
+    store : dict
+        NDC store with the ground truth bitset matrix, used instead of the true_ids of the records (or None)
+    ndc_setid : str
+        Whether the extraction is occuring at SETID level or NDC (value: 'ndc' or 'setid')
+
+    Returns
+    -------
+    groups : pandas.DataFrame
+        metrics per group (see group_metrics)
+    ingredients : pandas.DataFrame
+        confusion matrix per ingredient (see confusion)
+    errors : pandas.DataFrame
+        errors per item (see error_breakdown)
+    """
+    ri = read_reference_csv(config)
+    if filter_group:
+        ri = ri.loc[ri.GroupNumber.isin(filter_group)]
+    ri = ri.drop_duplicates('ReportedInactiveID').sort_values('ReportedInactiveID')
+    ri_ids, groups = ri.ReportedInactiveID.values, ri.GroupNumber.values
+
+    truth, found = build_matrices(records, ri_ids)
+    if store is not None and 'truth_bits' in store and (ndc_setid == 'ndc' or 'truth_setid' in store):
+        truth = truth_from_store(store, records, ri_ids, ndc_setid)
+
+    return group_metrics(truth, found, groups), confusion(truth, found, ri_ids), \
+        error_breakdown(records, truth, found, ri_ids, groups)
+
+
+def format_group_metrics(groups):
+    """ Metrics per group in the format reported in the README
+
+    Parameters
+    ----------
+    groups : pandas.DataFrame
+        metrics per group (see group_metrics)
+
+    Returns
+    -------
+    list
+        one line per group, ex: 'Group 1 tested 317; accuracy: 92.74% [with 23 errors and 255/264 (96.59%) True
+        Positive Rate; 14/67 (20.9%) False Positive Rate]'
+    """
+    def pct(x):
+        return f"{round(100 * x, 2):g}%" if not np.isnan(x) else "-"
+
+    return [f"Group {g.Group} tested {g.tested}; accuracy: {pct(g.accuracy)} [with {g.errors} errors and "
+            f"{g.tp}/{g.positives} ({pct(g.tpr)}) True Positive Rate; {g.fp}/{g.negatives} ({pct(g.fpr)}) "
+            f"False Positive Rate]" for g in groups.itertuples()]
@@ -0,0 +1,67 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from helpers.evaluation import evaluate
+from helpers.prompt import apply_prompt_set
+from helpers.rate_limit import get_scheduler
+
+
+def _totals(metrics):
+    """ Calls and estimated tokens summed over all the deployments of the scheduler metrics
+    """
+    return sum([m['calls'] for m in metrics.values()]), sum([m['estimated_tokens'] for m in metrics.values()])
+
+
+def run_experiment(items, prompt_sets, extract_fn, filter_group=None, store=None, ndc_setid='setid', io_workers=1):
+    """ Run several prompt sets over the same parsed documents in one process. Downloads, parsing and indexes
+    (embeddings included) are shared between the prompt sets through an index cache, only the LLM stages run again.
+    Prompt sets run one after the other, since the prompts are read from os.environ
+
+    Parameters
+    ----------
+    items : list
+        parsed searches (see helpers.parallel.prepare_searches)
+    prompt_sets : list
+        names of the prompt sets to compare (ex: ['set3', 'set4'])
+    extract_fn : callable
+        function called with (item, index_cache) returning the IDs found for the item (or None in case of error)
+    filter_group : list
+        groups to evaluate (None for all)
+    store : dict
+        NDC store with the ground truth bitset matrix (or None, see helpers.evaluation.evaluate)
+    ndc_setid : str
+        Whether the extraction is occuring at SETID level or NDC (value: 'ndc' or 'setid')
+    io_workers : int
+        number of items extracted at the same time
+
+    Returns
+    -------
+    table : pandas.DataFrame
+        one row per prompt set with: items, errors (failed extractions), accuracy (all the ingredients right), the
+        accuracy / TPR / FPR of each group, seconds, seconds per item, LLM calls and estimated tokens
+    """
+    index_cache = {}
+    rows = []
+    for prompt_set in prompt_sets:
+        apply_prompt_set(prompt_set)
+
+        calls_start, tokens_start = _totals(get_scheduler().metrics())
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=io_workers) as pool:
+            found = list(pool.map(lambda item: extract_fn(item, index_cache), items))
+        duration = time.time() - start
+        calls_end, tokens_end = _totals(get_scheduler().metrics())
+
+        records = [{'search': item['search'], 'setid': item['setid'], 'ndc11': item['ndc11'],
+                    'true_ids': item['todd_ing_ids'], 'found_ids': f} for item, f in zip(items, found) if f is not None]
+        row = {'prompt_set': prompt_set, 'items': len(records), 'errors': len(items) - len(records)}
+        if len(records) > 0:
+            groups, _, errors = evaluate(records, filter_group=filter_group, store=store, ndc_setid=ndc_setid)
+            row['accuracy'] = 1 - errors.shape[0] / len(records)
+            for g in groups.itertuples():
+                row.update({f'G{g.Group} accuracy': g.accuracy, f'G{g.Group} TPR': g.tpr, f'G{g.Group} FPR': g.fpr})
+        row.update({'seconds': duration, 'seconds/item': duration / max(len(items), 1),
+                    'LLM calls': calls_end - calls_start, 'estimated tokens': tokens_end - tokens_start})
+        rows.append(row)
+
+    return pd.DataFrame(rows)
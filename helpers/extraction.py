@@ -1,21 +1,42 @@
 import os
+import re
+import threading
 import time
 import pandas as pd
-from langchain.output_parsers import StructuredOutputParser
+from concurrent.futures import Future
+from functools import partial
+from helpers.config import configure_openai, local_embed_model
+from helpers.get_spl_data import LabelText
+from helpers.index_store import load_persisted_index, persist_index
+from helpers.inactive_ingredients_data import unii_index
+from helpers.prompt import group1_query
+from helpers.results_store import get_results_store, config_hash
+from helpers.rules import resolve_group2_3
+from helpers.spl_structured import get_route_dosage_form, find_product, describe_product
+from helpers.rate_limit import get_scheduler, estimate_tokens, PRIORITY_GROUP1, \
+    PRIORITY_GROUP2_3, PRIORITY_GROUP4_5, PRIORITY_EMBEDDINGS
 from helpers.schemas import prepare_schema_index_query_g1_setid, prepare_schema_query_g2_3, prepare_schema_query_g4, \
-    prepare_schema_index_query_g1_ndc_pre, prepare_schema_index_query_g1_ndc_pos, prepare_schema_query_g5
+    prepare_schema_index_query_g1_ndc_pre, prepare_schema_index_query_g1_ndc_pos, prepare_schema_query_g5, scheduled_query
 from helpers.util import print_time
-from langchain.embeddings import OpenAIEmbeddings
-from llama_index import ServiceContext, GPTListIndex, GPTKeywordTableIndex, \
-    GPTKnowledgeGraphIndex, PromptHelper, OpenAIEmbedding, LangchainEmbedding, GPTVectorStoreIndex
-from llama_index.callbacks import LlamaDebugHandler, CallbackManager
-from llama_index.llms import OpenAI, AzureOpenAI
-from llama_index.node_parser import SimpleNodeParser
-from llama_index.text_splitter import TokenTextSplitter
 
 
 RULES_CONFIG_FILE = 'data/LLM05_GROUP_2-5_RULES.csv'
 
+# Group 2-3 answers of the run: (prompt set, route, dosage form, candidate ingredients): Future with the answer
+GROUP2_3_CACHE = {}
+_GROUP2_3_LOCK = threading.Lock()
+
+# Group 1 results of the run shared by the labels with the same fingerprint: (fingerprint): Future with the result
+GROUP1_CLUSTERS = {}
+_GROUP1_LOCK = threading.Lock()
+
+# guards the index caches shared by the extraction threads (see index_data), whose entries are Futures
+_INDEX_CACHE_LOCK = threading.Lock()
+
+# how often each Group 1 retry path fired during the run (see group1_retry_reason)
+RETRY_STATS = {}
+_RETRY_STATS_LOCK = threading.Lock()
+
 
 def decompose(txt, remove_parentheses=False):
     """ Helper function to decompose aliases and ingredients names, to make it easier to match
@@ -95,10 +116,67 @@ def filter_valid_ingredients(inactive, inprint, both_inprint_outside, valid_inva
     return list(set(answer))
 
 
+def shared_nodes(doc_to_index, service_context, node_cache=None):
+    """ Chunks (nodes) of the documents and the document store holding them, shared by all the indexes built over the
+    same documents so the text is chunked and stored once instead of once per index
+
+    Parameters
+    ----------
+    doc_to_index : Document
+        Document to index
+    service_context : llama_index.indices.service_context.ServiceContext
+        service context whose node parser chunks the documents
+    node_cache : dict
+        nodes already parsed for the documents, the nodes are reused from it or added to it (None to always parse)
+
+    Returns
+    -------
+    nodes : list
+        nodes of the documents
+    docstore : llama_index.storage.docstore.SimpleDocumentStore
+        document store containing the nodes
+    """
+    def parse():
+        from llama_index.storage.docstore import SimpleDocumentStore
+
+        nodes = service_context.node_parser.get_nodes_from_documents(doc_to_index)
+        docstore = SimpleDocumentStore()
+        docstore.add_documents(nodes)
+        return nodes, docstore
+
+    if node_cache is None:
+        return parse()
+
+    return _memoized(node_cache, ('nodes', tuple([d.id_ for d in doc_to_index])), parse)
+
+
+def _memoized(cache, key, fn):
+    """ Value of a key of an index cache, computed with fn by the first thread asking for it while the other threads
+    asking for the same key wait for it (errors are not memoized)
+    """
+    with _INDEX_CACHE_LOCK:
+        future = cache.get(key)
+        owner = future is None
+        if owner:
+            future = cache[key] = Future()
+
+    if owner:
+        try:
+            future.set_result(fn())
+        except Exception as e:
+            with _INDEX_CACHE_LOCK:
+                del cache[key]
+            future.set_exception(e)
+
+    return future.result()
+
+
 def index_data(doc_to_index,
                deployment_env_key=None,
                model_env_key="MODEL_GROUP1",
-               indexing_structure=os.environ['INDEXING_METHOD']):
+               indexing_structure=os.environ['INDEXING_METHOD'],
+               cache=None,
+               nodes=None):
     """ Method to get Service Context
 
     Parameters
@@ -110,16 +188,48 @@ def index_data(doc_to_index,
     model_env_key : str
         Environment variable name containing OpenAI Model name
     indexing_structure : str
-        Indexing structure name: list-index | vector-store | keyword-table | knowledge-graph
+        Indexing structure name: list-index | vector-store | hybrid-bm25 | keyword-table | knowledge-graph
+    cache : dict
+        indexes already built (ex: by the other prompt sets of an experiment), the index is reused from it or added to
+        it, threads asking for an index being built wait for it (None to always build it)
+    nodes : dict
+        nodes shared by the indexes of the same documents (see shared_nodes), when there is no index cache
 
     Returns
     -------
     service_context : llama_index.indices.service_context.ServiceContext
         Service context containing Model definition, context window, ....
     """
+    if cache is None:
+        return _build_index(doc_to_index, deployment_env_key, model_env_key, indexing_structure, None, nodes)
+
+    # the index only depends on the document, the model and the structure, not on the prompts
+    cache_key = (tuple([d.id_ for d in doc_to_index]), deployment_env_key, model_env_key, indexing_structure)
+    return _memoized(cache, cache_key, partial(_build_index, doc_to_index, deployment_env_key, model_env_key,
+                                               indexing_structure, cache, nodes))
+
+
+def _build_index(doc_to_index, deployment_env_key, model_env_key, indexing_structure, cache, nodes):
+    """ Build the index of the documents (see index_data)
+    """
+    # hybrid retrieval: the vector index (persisted like any other) plus a local BM25 index of its nodes
+    if indexing_structure == 'hybrid-bm25':
+        from helpers.hybrid_index import HybridIndex
+
+        # only the Group 1 queries are about the ingredient sections
+        index = HybridIndex(index_data(doc_to_index, deployment_env_key, model_env_key, 'vector-store', cache, nodes),
+                            section_terms=model_env_key.startswith("MODEL_GROUP1"))
+        return index
+
+    # llama_index / langchain are imported here (and only the index class that is used) to keep start up fast
+    from llama_index import ServiceContext, PromptHelper, StorageContext
+
+    configure_openai()
 
     model = os.environ[model_env_key]
     if os.environ['AZURE_API'] != '':
+        from llama_index.llms import AzureOpenAI
+
         deployment = os.environ.get(deployment_env_key, model)
         llm_predictor = AzureOpenAI(engine=deployment,
                                     model=model,
@@ -130,6 +240,9 @@ def index_data(doc_to_index,
             embed_deployment_name = os.environ.get("OPENAI_EMBEDDINGS_DEPLOYMENT", embed_model_name)
             
             try:
+                from langchain.embeddings import OpenAIEmbeddings
+                from llama_index import LangchainEmbedding
+
                 embed_model = LangchainEmbedding(OpenAIEmbeddings(
                     deployment=embed_deployment_name,
                     model=embed_model_name,
@@ -142,20 +255,36 @@ def index_data(doc_to_index,
         else:
             embed_model = None
     else:
+        from llama_index.llms import OpenAI
+
         llm_predictor = OpenAI(temperature=0, model=model)
 
         if os.environ["OPENAI_USE_EMBEDDINGS"] == "True":
+            from llama_index import OpenAIEmbedding
+
             embed_model = OpenAIEmbedding()
         else:
             embed_model = None
 
+    # a local embedding model takes precedence over the embeddings endpoint
+    local_embeddings = local_embed_model()
+    if local_embeddings is not None:
+        embed_model = local_embeddings
+    # otherwise the chunks of all the labels in flight are embedded together, identical chunks once
+    batched_embeddings = local_embeddings is None and os.environ.get('EMBEDDING_BATCHER', 'True') == 'True'
+    if batched_embeddings:
+        from helpers.batched_embedding import batched_embed_model
+
+        embed_model = batched_embed_model(embed_model)
+
     if os.environ['DEBUG'] == 'True':
+        from llama_index.callbacks import LlamaDebugHandler, CallbackManager
+
         llama_debug = LlamaDebugHandler(print_trace_on_end=True)
         callback_manager = CallbackManager([llama_debug])
     else:
         callback_manager = None
 
-    node_parser = SimpleNodeParser(text_splitter=TokenTextSplitter(chunk_size=2024, chunk_overlap=20))
     prompt_helper = PromptHelper(num_output=512,
                                  chunk_overlap_ratio=0.2,
                                  chunk_size_limit=None,
@@ -169,21 +298,130 @@ def index_data(doc_to_index,
                                                    prompt_helper=prompt_helper
                                                    )
 
+    # vector indexes persisted by an earlier run or worker are loaded instead of embedding the documents again
     if indexing_structure == 'vector-store':
-        index = GPTVectorStoreIndex.from_documents(doc_to_index, service_context=service_context)
+        index = load_persisted_index(doc_to_index, service_context)
+        if index is not None:
+            return index
+
+    # the documents are chunked once, every index is built over the same nodes and document store (each index keeps
+    # its own vector store, so the retrieval of an index only sees its own embeddings)
+    doc_nodes, docstore = shared_nodes(doc_to_index, service_context, cache if cache is not None else nodes)
+    storage_context = StorageContext.from_defaults(docstore=docstore)
+
+    # building a vector store calls the embeddings deployment, keyword-table / knowledge-graph call the LLM (the label
+    # is only tokenized for the calls going through the scheduler)
+    scheduler = get_scheduler()
+    if indexing_structure == 'vector-store':
+        from llama_index import GPTVectorStoreIndex
+        if local_embeddings is not None or batched_embeddings:
+            # embedded in process, or the batcher waits for the quota of each of its requests
+            index = GPTVectorStoreIndex(doc_nodes, service_context=service_context, storage_context=storage_context)
+        else:
+            index = scheduler.call("OPENAI_EMBEDDINGS_DEPLOYMENT", GPTVectorStoreIndex, doc_nodes,
+                                   service_context=service_context, storage_context=storage_context,
+                                   prompt_tokens=sum([estimate_tokens(d.text) for d in doc_to_index]), output_tokens=0,
+                                   priority=PRIORITY_EMBEDDINGS)
+        persist_index(index, doc_to_index)
     elif indexing_structure == 'list-index':
-        index = GPTListIndex.from_documents(doc_to_index, service_context=service_context)
+        from llama_index import GPTListIndex
+        index = GPTListIndex(doc_nodes, service_context=service_context, storage_context=storage_context)
     elif indexing_structure == 'keyword-table':
-        index = GPTKeywordTableIndex.from_documents(doc_to_index, service_context=service_context)
+        from llama_index import GPTKeywordTableIndex
+        index = scheduler.call(deployment_env_key, GPTKeywordTableIndex, doc_nodes, service_context=service_context,
+                               storage_context=storage_context,
+                               prompt_tokens=sum([estimate_tokens(d.text) for d in doc_to_index]))
     elif indexing_structure == 'knowledge-graph':
-        index = GPTKnowledgeGraphIndex.from_documents(doc_to_index, service_context=service_context)
+        from llama_index import GPTKnowledgeGraphIndex
+        index = scheduler.call(deployment_env_key, GPTKnowledgeGraphIndex, doc_nodes, service_context=service_context,
+                               storage_context=storage_context,
+                               prompt_tokens=sum([estimate_tokens(d.text) for d in doc_to_index]))
     else:
         index = None
 
     return index
 
 
-def process_output_group1(txt, output_parser, possible_inactive, _logger=None):
+def query_index(query_engine, _index, query, deployment_env_key, priority=PRIORITY_GROUP1):
+    """ Query an index through the rate limit aware scheduler of the deployment
+
+    Parameters
+    ----------
+    query_engine : QueryEngine
+        query engine from the index
+    _index : llama_index.schema.indices
+        the index queried (used to estimate the tokens of the call)
+    query : str
+        query to run
+    deployment_env_key : str
+        Environment variable containing Azure OpenAI deployment name used by the index
+    priority : int
+        priority of the call in the deployment queue (lower goes first)
+
+    Returns
+    -------
+    response : llama_index.response.schema.Response
+        response of the query engine
+    """
+    return scheduled_query(query_engine, _index, query, deployment_env_key, priority=priority)
+
+
+def _run_group2_3(df_gp2, df_gp3, route, dosage_form):
+    """ Run the Group 2 and 3 structured output chain (see prepare_schema_query_g2_3)
+    """
+    chain = prepare_schema_query_g2_3(df_gp2, df_gp3)
+    prompt_tokens = estimate_tokens(chain.prompt.format(route=route, dosage_form=dosage_form) + str(chain.llm_kwargs))
+
+    return get_scheduler().call("DEPLOYMENT_GROUP2-3", chain.run, route=route, dosage_form=dosage_form,
+                                prompt_tokens=prompt_tokens, priority=PRIORITY_GROUP2_3)
+
+
+def query_group2_3(df_gp2, df_gp3, route, dosage_form):
+    """ Group 2 and 3 decisions of a product. The answer only depends on the route, the dosage form and the candidate
+    ingredients (and the prompt set), so unless GROUP2_3_CACHE is 'False' answers are memoized by that key for the
+    whole run, and products sharing a key wait for the call already in flight instead of repeating it.
+
+    Parameters
+    ----------
+    df_gp2 : pandas.DataFrame
+        information of the ingredients found and its rules for Group 2
+    df_gp3 : pandas.DataFrame
+        information of the ingredients found and its rules for Group 3
+    route : str
+        route of administration of the product
+    dosage_form : str
+        dosage form of the product
+
+    Returns
+    -------
+    answer : dict
+        For group 2: (name_ingredient): Include/Exclude. For Group 3: (name_ingredient): (choice of ingredient)
+    """
+    if os.environ.get('GROUP2_3_CACHE', 'True') != 'True':
+        return _run_group2_3(df_gp2, df_gp3, route, dosage_form)
+
+    key = (os.environ.get('PROMPT_SET', ''), route.strip().lower(), dosage_form.strip().lower(),
+           tuple(sorted(df_gp2.Name.tolist())), tuple(sorted(df_gp3.Name.tolist())))
+
+    with _GROUP2_3_LOCK:
+        future = GROUP2_3_CACHE.get(key)
+        owner = future is None
+        if owner:
+            future = GROUP2_3_CACHE[key] = Future()
+
+    if owner:
+        try:
+            future.set_result(_run_group2_3(df_gp2, df_gp3, route, dosage_form))
+        except Exception as e:
+            # errors are not memoized, the next product with the same key will try again
+            with _GROUP2_3_LOCK:
+                del GROUP2_3_CACHE[key]
+            future.set_exception(e)
+
+    return dict(future.result())
+
+
+def process_output_group1(txt, output_parser, possible_inactive, _logger=None, _status=None):
     """ Method to extract the outcome of LLM for group 1 extraction
 
     Parameters
@@ -196,6 +434,9 @@ def process_output_group1(txt, output_parser, possible_inactive, _logger=None):
         Dictionary containing all the possible inactive ingredients and its aliases
     _logger : logging
         logger object (or None, in case no logging)
+    _status : dict
+        filled with the structural signals of the output (or None): parsed (the output could be parsed) and
+        raw_inactive (inactive ingredients answered, before filtering)
 
     Returns
     -------
@@ -215,6 +456,8 @@ def process_output_group1(txt, output_parser, possible_inactive, _logger=None):
     except Exception as e:
         print(f"error with structured extraction:\n\toriginal output: {txt}\n\terror:'{e.__str__()}'")
         response_treated = {}
+        if _status is not None:
+            _status['parsed'] = False
 
     _list_inactive = response_treated['FoundInactiveIngredients'] if 'FoundInactiveIngredients' in response_treated else []
     list_inactive = []
@@ -225,6 +468,9 @@ def process_output_group1(txt, output_parser, possible_inactive, _logger=None):
             list_inactive.append(c)
 
     list_inactive = [c.lower() for c in list_inactive]
+    if _status is not None:
+        _status.setdefault('parsed', True)
+        _status['raw_inactive'] = [c.strip() for c in list_inactive]
 
     list_inactive_printing_ink = response_treated['IngredientsPrintingInk'] if 'IngredientsPrintingInk' in response_treated else []
     list_inactive_printing_ink = [c.lower() for c in list_inactive_printing_ink]
@@ -276,6 +522,359 @@ def process_output_group1(txt, output_parser, possible_inactive, _logger=None):
     return result, product_route, product_df, found_ndc_info
 
 
+def coded_group1(products, possible_inactive, inactive_ids, label):
+    """ Group 1 ingredients read from the inactive ingredients coded in the SPL (ingredient classCode="IACT"), matched
+    by UNII code (AliasType=UNII) and by name. The coded data can't tell apart the printing ink ingredients, so labels
+    mentioning ink go through the LLM, as well as products without coded ingredients or with ingredients lacking UNII
+
+    Parameters
+    ----------
+    products : list
+        products of the SPL (or the product of the NDC) extracted with parse_spl_products
+    possible_inactive : dict
+        Dictionary containing all the possible inactive ingredients and its aliases
+    inactive_ids : dict
+        Dictionary containing all the available inactive ingredients and its corresponding ID
+    label : LabelText
+        text of the label (see helpers.get_spl_data.LabelText)
+
+    Returns
+    -------
+    list
+        inactive ingredients found, same format as process_output_group1 (None if the LLM is needed)
+    """
+    coded = [i for p in products for i in p['inactive']]
+    if len(products) == 0 or any([len(p['inactive']) == 0 for p in products]) or \
+            any([i['unii'] == '' for i in coded]) or label.has_words("ink"):
+        return None
+
+    id_inact = {k: ina for ina, ids in inactive_ids.items() for k in ids}
+    uniis = unii_index()
+    found = set([id_inact[k] for i in coded for k in uniis.get(i['unii'].upper(), []) if k in id_inact])
+
+    inactive_decomposed = {i: [sorted(decompose(a)) for a in al] for i, al in possible_inactive.items()}
+    found.update(filter_valid_ingredients([i['name'].lower() for i in coded], [], [], inactive_decomposed,
+                                          already_decomposed=True))
+
+    return list(found)
+
+
+def alias_prescreen(label, possible_inactive):
+    """ Whether any alias of the possible inactive ingredients appears in the text (cheap keyword check, no LLM
+    involved), stops at the first alias found
+
+    Parameters
+    ----------
+    label : LabelText
+        text to check, the inactive ingredients sections of the label (see helpers.get_spl_data.LabelText.section)
+    possible_inactive : dict
+        Dictionary containing all the possible inactive ingredients and its aliases
+
+    Returns
+    -------
+    bool
+        True if at least one alias is found
+    """
+    return any(label.has_words(a) for aliases in possible_inactive.values() for a in aliases if len(a) > 2)
+
+
+def group1_retry_reason(status, found_ing, found_ndc_info, ndc_specific, label, possible_inactive):
+    """ Decide whether the Group 1 answer must be re-queried on the whole SPL, from structural signals of the answer
+    and of the label instead of re-querying every time the answer is empty or mentions 'unknown'
+
+    Parameters
+    ----------
+    status : dict
+        structural signals of the answer (see process_output_group1)
+    found_ing : list
+        inactive ingredients found
+    found_ndc_info : bool
+        whether the LLM found information specific to the product of the NDC
+    ndc_specific : bool
+        whether the query was about the product of an NDC (instead of the whole SPL)
+    label : LabelText
+        text of the label (see helpers.get_spl_data.LabelText)
+    possible_inactive : dict
+        Dictionary containing all the possible inactive ingredients and its aliases
+
+    Returns
+    -------
+    str
+        reason of the retry ('parse_error', 'unknown_answer', 'ndc_not_specific', 'empty_with_alias_hits'), or None
+        when the answer is kept
+    """
+    if not status.get('parsed', False):
+        return 'parse_error'
+    if any([i == 'unknown' for i in status.get('raw_inactive', [])]):
+        return 'unknown_answer'
+    if found_ing != []:
+        return None
+    if ndc_specific:
+        # an empty answer specific to the product of the NDC is kept, the whole SPL would list the other products too
+        return 'ndc_not_specific' if not found_ndc_info else None
+    # an empty answer is only doubted when the inactive ingredients section lists ingredients we know about (common
+    # aliases like 'water' appear elsewhere in almost every label)
+    if alias_prescreen(label.section(["inactive ingredient", "excipient"]), possible_inactive):
+        return 'empty_with_alias_hits'
+    return None
+
+
+def count_retry(reason):
+    """ Count a Group 1 retry path in RETRY_STATS ('no_retry' when the answer was kept)
+    """
+    with _RETRY_STATS_LOCK:
+        RETRY_STATS[reason or 'no_retry'] = RETRY_STATS.get(reason or 'no_retry', 0) + 1
+
+
+def query_group1(_ndc, _ndcs, _ndc_setid, _inactive_ing, _doc_to_index, _spl_products, ask_route_df,
+                 _label, _index_cache=None, _nodes=None):
+    """ Group 1 query through the LLM: for an NDC the product of the NDC is first identified (from the SPL packaging
+    data or by asking the LLM), then the inactive ingredients of the product (or of the whole SPL) are extracted
+
+    Parameters
+    ----------
+    _ndc : str
+        NDC RAW text
+    _ndcs : str
+        list of all RAW _NDCs present in FDB for the specific SetID
+    _ndc_setid : str
+        Whether the extraction is occuring at SETID level or NDC (value: 'ndc' or 'setid')
+    _inactive_ing : dict
+        Dictionary containing all the available inactive ingredients and its aliases
+    _doc_to_index : Document with content
+        Llama Document with content
+    _spl_products : list
+        products coded in the SPL XML (see helpers.spl_structured.parse_spl_products), or None if not available
+    ask_route_df : bool
+        whether the route and dosage form are asked to the LLM
+    _label : LabelText
+        text of the label (see helpers.get_spl_data.LabelText)
+    _index_cache : dict
+        indexes shared between runs over the same documents (see index_data)
+    _nodes : dict
+        nodes shared by the indexes of the document (see shared_nodes)
+
+    Returns
+    -------
+    found_ing : list
+        inactive ingredients found
+    found_route : str
+        The Distribution Route found in the product
+    found_df : str
+        The Dosage Form found in the product
+    product_size_ndc : str
+        The NDC information, meaning the product distinguish features of the NDC (ex: 10mg, 20mg, 30mg)
+    """
+    product_size_ndc = ""
+    ndc_specific = False
+    if _ndc_setid == 'setid':
+        _index_g1 = index_data(_doc_to_index,
+                               deployment_env_key="DEPLOYMENT_GROUP1",
+                               model_env_key="MODEL_GROUP1", cache=_index_cache, nodes=_nodes)
+        query_engine, output_parser = prepare_schema_index_query_g1_setid(_index_g1, ask_route_df)
+        query = group1_query("qa_prompt", ask_route_df)
+        _index_query, deployment_key = _index_g1, "DEPLOYMENT_GROUP1"
+    # if NDC then perform extra steps
+    else:
+        # the packaging coded in the SPL maps the NDC to its product, otherwise the LLM is asked for it
+        spl_product = find_product(_spl_products or [], _ndc)
+        if spl_product is not None:
+            product_size_ndc = describe_product(spl_product)
+            _index_g1 = None
+        else:
+            _index_g1 = index_data(_doc_to_index,
+                                   deployment_env_key="DEPLOYMENT_GROUP1",
+                                   model_env_key="MODEL_GROUP1", indexing_structure="list-index",
+                                   cache=_index_cache, nodes=_nodes)
+
+            query_engine, output_parser = prepare_schema_index_query_g1_ndc_pre(_index_g1, _ndcs)
+            query = os.environ["group_1_ndc_pre"].format(ndcs = ", ".join(_ndcs))
+
+            response = query_index(query_engine, _index_g1, query, "DEPLOYMENT_GROUP1")
+            # print(response) -----getting an error in retrieving the response
+            answer = output_parser.parse(response.response)
+
+            product_size_ndc = answer[f"NDC {_ndc} Information"]
+        #print("product_size_ndc", product_size_ndc, end=": ")
+        # a label with a single product has all its inactive ingredients on the NDC
+        if product_size_ndc == 'Not Available' or (spl_product is not None and len(_spl_products) == 1):
+            _index_g1 = index_data(_doc_to_index,
+                                   deployment_env_key="DEPLOYMENT_GROUP1",
+                                   model_env_key="MODEL_GROUP1", cache=_index_cache, nodes=_nodes)
+            query_engine, output_parser = prepare_schema_index_query_g1_setid(_index_g1, ask_route_df)
+            query = group1_query("qa_prompt", ask_route_df)
+            _index_query, deployment_key = _index_g1, "DEPLOYMENT_GROUP1"
+        else:
+            query = group1_query("group_1_ndc_pos", ask_route_df).replace("{selected_product}", product_size_ndc)
+            _index_g1_pos = index_data(_doc_to_index,
+                                       deployment_env_key="DEPLOYMENT_GROUP1-pos",
+                                       model_env_key="MODEL_GROUP1-pos", cache=_index_cache, nodes=_nodes)
+            query_engine, output_parser = prepare_schema_index_query_g1_ndc_pos(_index_g1_pos, product_size_ndc,
+                                                                                ask_route_df)
+            _index_query, deployment_key = _index_g1_pos, "DEPLOYMENT_GROUP1-pos"
+            ndc_specific = True
+
+    response = query_index(query_engine, _index_query, query, deployment_key)
+    # print(response.response)
+    status = {}
+    found_ing, found_route, found_df, found_ndc_info = process_output_group1(response.response, output_parser,
+                                                                             _inactive_ing, _status=status)
+    reason = group1_retry_reason(status, found_ing, found_ndc_info, ndc_specific, _label, _inactive_ing)
+    count_retry(reason)
+    if reason is not None:
+        # the product came from the SPL so no pre query index was built, the whole SPL is asked on the Group 1 one
+        if _index_g1 is None:
+            _index_g1 = index_data(_doc_to_index,
+                                   deployment_env_key="DEPLOYMENT_GROUP1",
+                                   model_env_key="MODEL_GROUP1", cache=_index_cache, nodes=_nodes)
+        query_engine, output_parser = prepare_schema_index_query_g1_setid(_index_g1, ask_route_df)
+        query = group1_query("qa_prompt", ask_route_df)
+        response = query_index(query_engine, _index_g1, query, "DEPLOYMENT_GROUP1")
+        found_ing, found_route, found_df, found_ndc_info = process_output_group1(response.response, output_parser, _inactive_ing)
+
+    return found_ing, found_route, found_df, product_size_ndc
+
+
+def run_group1(_ndc, _ndcs, _ndc_setid, _inactive_ing, _inactive_ids, _doc_to_index, _spl_products, _label,
+               _logger=None, _index_cache=None, _nodes=None):
+    """ Group 1 stage: the inactive ingredients coded in the SPL are used when they are complete, otherwise the LLM
+    is queried (see query_group1)
+
+    Parameters
+    ----------
+    _ndc : str
+        NDC RAW text
+    _ndcs : str
+        list of all RAW _NDCs present in FDB for the specific SetID
+    _ndc_setid : str
+        Whether the extraction is occuring at SETID level or NDC (value: 'ndc' or 'setid')
+    _inactive_ing : dict
+        Dictionary containing all the available inactive ingredients and its aliases
+    _inactive_ids : dict
+        Dictionary containing all the available inactive ingredients and its corresponding ID
+    _doc_to_index : Document with content
+        Llama Document with content
+    _spl_products : list
+        products coded in the SPL XML (see helpers.spl_structured.parse_spl_products), or None if not available
+    _label : LabelText
+        text of the label (see helpers.get_spl_data.LabelText)
+    _logger : logging
+        logger object (or None, in case no logging)
+    _index_cache : dict
+        indexes shared between runs over the same documents (see index_data)
+    _nodes : dict
+        nodes shared by the indexes of the document (see shared_nodes)
+
+    Returns
+    -------
+    dict
+        result of the stage with keys: found_ing, found_route, found_df, product_size_ndc
+    """
+    # route and dosage form coded in the SPL are used instead of asking the LLM for them
+    spl_route, spl_df = get_route_dosage_form(_spl_products or [], _ndc if _ndc_setid == 'ndc' else None)
+    ask_route_df = spl_route == '' or spl_df == ''
+
+    found_ing = None
+    if _ndc_setid == 'setid':
+        coded_products = _spl_products or []
+    else:
+        coded_products = [p for p in [find_product(_spl_products or [], _ndc)] if p is not None]
+    if os.environ.get('SPL_CODED_INGREDIENTS', 'True') == 'True' and not ask_route_df:
+        found_ing = coded_group1(coded_products, _inactive_ing, _inactive_ids, _label)
+
+    if found_ing is not None:
+        found_route, found_df = spl_route, spl_df
+        product_size_ndc = describe_product(coded_products[0]) if _ndc_setid == 'ndc' else ""
+        if _logger is not None:
+            _logger.info(f'Group 1 from SPL coded ingredients: ' + ", ".join(found_ing))
+    else:
+        found_ing, found_route, found_df, product_size_ndc = query_group1(_ndc, _ndcs, _ndc_setid, _inactive_ing,
+                                                                          _doc_to_index, _spl_products, ask_route_df,
+                                                                          _label, _index_cache=_index_cache,
+                                                                          _nodes=_nodes)
+        if not ask_route_df:
+            found_route, found_df = spl_route, spl_df
+
+    return {'found_ing': found_ing, 'found_route': found_route, 'found_df': found_df,
+            'product_size_ndc': product_size_ndc}
+
+
+def group1_fingerprint(inactive_section, _ndc, _ndc_setid, _spl_products):
+    """ Fingerprint of the inputs of the Group 1 stage of a label: its inactive ingredients section, the product of the
+    NDC (at NDC level, the section may list the ingredients of several products) and the configuration of the run
+
+    Parameters
+    ----------
+    inactive_section : str
+        hash of the inactive ingredients section (see helpers.spl_structured.inactive_section_hash)
+    _ndc : str
+        NDC RAW text
+    _ndc_setid : str
+        Whether the extraction is occuring at SETID level or NDC (value: 'ndc' or 'setid')
+    _spl_products : list
+        products coded in the SPL XML (see helpers.spl_structured.parse_spl_products), or None if not available
+
+    Returns
+    -------
+    str
+        sha256 hex digest, or None when the label can't be fingerprinted (no section, or unknown product of the NDC)
+    """
+    import hashlib
+
+    if not inactive_section:
+        return None
+
+    product = ""
+    if _ndc_setid == 'ndc':
+        spl_product = find_product(_spl_products or [], _ndc)
+        if spl_product is None:
+            return None
+        product = describe_product(spl_product) + "|" + ",".join(spl_product['routes'])
+
+    txt = "|".join([config_hash(), _ndc_setid, product, inactive_section])
+
+    return hashlib.sha256(txt.encode()).hexdigest()
+
+
+def shared_group1(fingerprint, search, run):
+    """ Group 1 result of a label with the same fingerprint: from the labels of the run (a label being processed is
+    waited for), then from the results store, otherwise it is computed with run and shared
+
+    Parameters
+    ----------
+    fingerprint : str
+        fingerprint of the label (see group1_fingerprint)
+    search : str
+        SetID or RAW NDC of the label
+    run : callable
+        function computing the Group 1 stage (see run_group1)
+
+    Returns
+    -------
+    dict
+        result of the stage with keys: found_ing, found_route, found_df, product_size_ndc, search (label the result
+        comes from)
+    """
+    with _GROUP1_LOCK:
+        future = GROUP1_CLUSTERS.get(fingerprint)
+        owner = future is None
+        if owner:
+            future = GROUP1_CLUSTERS[fingerprint] = Future()
+
+    if owner:
+        try:
+            store = get_results_store()
+            stored = store.find_group1(fingerprint) if store is not None else None
+            future.set_result(dict(stored) if stored is not None else dict(run(), search=search))
+        except Exception as e:
+            # errors are not shared, the next label with the same fingerprint will try again
+            with _GROUP1_LOCK:
+                del GROUP1_CLUSTERS[fingerprint]
+            future.set_exception(e)
+
+    return dict(future.result())
+
+
 def process_output_group2_3(answer, name2id):
     """ Helper function to process output from LLM regarding Group 2 and 3
 
@@ -338,7 +937,8 @@ def process_output_group4_5(response, output_parser, name2id):
 
 
 def extract_ingredients(_setid, _ndc, _ndcs, _ndc_setid, _inactive_ing, _inactive_groups, _inactive_ids, _doc_to_index,
-                        _filter_groups, _logger=None, _true_ing=None):
+                        _filter_groups, _logger=None, _true_ing=None, _spl_products=None, _stages=None,
+                        _index_cache=None, _inactive_section=None):
     """ Main extract ingredients method to extract all the inactive ingredients from an SPL
 
     Parameters
@@ -365,6 +965,16 @@ def extract_ingredients(_setid, _ndc, _ndcs, _ndc_setid, _inactive_ing, _inactiv
         logger object (or None, in case no logging)
     _true_ing : list
         IDs found in Todd's rules which correspond at the moment to the "true" labels
+    _spl_products : list
+        products coded in the SPL XML (see helpers.spl_structured.parse_spl_products), or None if not available
+    _stages : dict
+        results of the stages ('group1', 'group2_3', 'group4_5') to reuse instead of querying them (see
+        helpers.results_store.ResultsStore.reusable_stages). The results of the stages that run are added to it
+    _index_cache : dict
+        indexes shared between runs over the same documents, ex: the prompt sets of an experiment (see index_data)
+    _inactive_section : str
+        hash of the inactive ingredients section (see helpers.spl_structured.inactive_section_hash), labels with the
+        same one share their Group 1 result (None to always run it)
 
     Returns
     -------
@@ -379,51 +989,39 @@ def extract_ingredients(_setid, _ndc, _ndcs, _ndc_setid, _inactive_ing, _inactiv
     if _logger is not None:
         _logger.info(f'Extract ingredients: first doing Vector search then tagging with alias')
 
-    try:
-        # Group 1 query
-        product_size_ndc = ""
-        if _ndc_setid == 'setid':
-            _index_g1 = index_data(_doc_to_index,
-                                   deployment_env_key="DEPLOYMENT_GROUP1",
-                                   model_env_key="MODEL_GROUP1")
-            query_engine, output_parser = prepare_schema_index_query_g1_setid(_index_g1)
-            query = os.environ["qa_prompt"]
-        # if NDC then perform extra steps
-        else:
-            _index_g1 = index_data(_doc_to_index,
-                                   deployment_env_key="DEPLOYMENT_GROUP1",
-                                   model_env_key="MODEL_GROUP1", indexing_structure="list-index")
-            
-            query_engine, output_parser = prepare_schema_index_query_g1_ndc_pre(_index_g1, _ndcs)
-            query = os.environ["group_1_ndc_pre"].format(ndcs = ", ".join(_ndcs))
-            
-            response = query_engine.query(query)
-            # print(response) -----getting an error in retrieving the response
-            answer = output_parser.parse(response.response)
+    _stages = {} if _stages is None else _stages
+    # the document is chunked once for all the indexes, the chunks are released once the last index is built (the
+    # indexes of a stage are released when it is done, unless they are kept in _index_cache by an experiment)
+    _nodes = {}
+    # the text of the label is joined and lower cased once for all the keyword checks
+    label = LabelText(_doc_to_index)
 
-            product_size_ndc = answer[f"NDC {_ndc} Information"]
-            #print("product_size_ndc", product_size_ndc, end=": ")
-            if product_size_ndc == 'Not Available':
-                _index_g1 = index_data(_doc_to_index,
-                                       deployment_env_key="DEPLOYMENT_GROUP1",
-                                       model_env_key="MODEL_GROUP1")
-                query_engine, output_parser = prepare_schema_index_query_g1_setid(_index_g1)
-                query = os.environ["qa_prompt"]
+    try:
+        # stages whose input sections didn't change since the previous revision are reused
+        if 'group1' not in _stages:
+            fingerprint = group1_fingerprint(_inactive_section, _ndc, _ndc_setid, _spl_products)
+            run = partial(run_group1, _ndc, _ndcs, _ndc_setid, _inactive_ing, _inactive_ids, _doc_to_index,
+                          _spl_products, label, _logger=_logger, _index_cache=_index_cache, _nodes=_nodes)
+            # labels with the same inactive ingredients section (ex: repackagers) share their Group 1 result
+            if fingerprint is not None and os.environ.get('GROUP1_FINGERPRINT', 'True') == 'True':
+                _stages['group1'] = shared_group1(fingerprint, _ndc, run)
+                if _stages['group1'].get('search', _ndc) != _ndc:
+                    # the route and dosage form coded in this label still take precedence
+                    spl_route, spl_df = get_route_dosage_form(_spl_products or [],
+                                                              _ndc if _ndc_setid == 'ndc' else None)
+                    if spl_route != '' and spl_df != '':
+                        _stages['group1'].update({'found_route': spl_route, 'found_df': spl_df})
+                    if _logger is not None:
+                        _logger.info(f"Group 1 shared with {_stages['group1']['search']} (same inactive ingredients)")
             else:
-                query = os.environ["group_1_ndc_pos"].replace("{selected_product}", product_size_ndc)
-                _index_g1_pos = index_data(_doc_to_index,
-                                           deployment_env_key="DEPLOYMENT_GROUP1-pos",
-                                           model_env_key="MODEL_GROUP1-pos")
-                query_engine, output_parser = prepare_schema_index_query_g1_ndc_pos(_index_g1_pos, product_size_ndc)
-
-        response = query_engine.query(query)
-        # print(response.response)
-        found_ing, found_route, found_df, found_ndc_info = process_output_group1(response.response, output_parser, _inactive_ing)
-        if "unknown" in response.response.lower() or (found_ing == [] and not found_ndc_info):
-            query_engine, output_parser = prepare_schema_index_query_g1_setid(_index_g1)
-            query = os.environ["qa_prompt"]
-            response = query_engine.query(query)
-            found_ing, found_route, found_df, found_ndc_info = process_output_group1(response.response, output_parser, _inactive_ing)
+                _stages['group1'] = run()
+            _stages['group1'].update({'fingerprint': fingerprint, 'search': _ndc})
+        if 'group4_5' in _stages:
+            _nodes.clear()
+
+        stage = _stages['group1']
+        found_ing, found_route, found_df = stage['found_ing'], stage['found_route'], stage['found_df']
+        product_size_ndc = stage['product_size_ndc']
 
         # will start by saving the IDs of Group 1
         result_ids_g1 = [list(_inactive_ids[inactive])[0] for inactive in found_ing if _inactive_groups[inactive] == 1]
@@ -437,47 +1035,54 @@ def extract_ingredients(_setid, _ndc, _ndcs, _ndc_setid, _inactive_ing, _inactiv
         df_gp2 = df.loc[df.FDB_HICDDESC.isin(found_ing) & (df.Group == 2)]
         df_gp4 = df.loc[df.Group == 4]
 
-        # Only run Group 2 and 3 Query if there were any ingredient found
-        if (df_gp2.shape[0] + df_gp3.shape[0]) > 0:
-            chain = prepare_schema_query_g2_3(df_gp2, df_gp3)
-            answer = chain.run(route=found_route, dosage_form=found_df)
+        if 'group2_3' in _stages:
+            result_ids_g2_3 = _stages['group2_3']['result_ids']
         else:
-            answer = {}
-
-        result_ids_g2_3 = process_output_group2_3(answer, name2id)
-
-        # Group 4
-        _index_g4 = index_data(_doc_to_index,
-                               deployment_env_key="DEPLOYMENT_GROUP4-5",
-                               model_env_key="MODEL_GROUP4-5")
-        query_engine, output_parser = prepare_schema_query_g4(_index_g4, df_gp4)
-        response = query_engine.query(os.environ["schema_group4_5_query"])
-        result_ids_g4 = process_output_group4_5(response, output_parser, name2id)
-
-        # Group 5
-        whole_txt = "\n".join([_index_g4.docstore.docs[doc].dict()['text'] for doc in _index_g4.docstore.docs])
-        result_ids_g5 = []
-        if "latex" in whole_txt.lower():
-            _index_g5 = index_data(_doc_to_index,
-                                   deployment_env_key="DEPLOYMENT_GROUP4-5",
-                                   model_env_key="MODEL_GROUP4-5")
-            answer = prepare_schema_query_g5(_index_g5, "latex or any latex related substance", "Latex")
-            if "Found Latex" in answer and answer["Found Latex"] in [1, '1']:
-                result_ids_g5.append(name2id["latex"])
-        elif "rubber" in whole_txt.lower():
-            _index_g5 = index_data(_doc_to_index,
+            # decisions on route lists are resolved with the rules table, the LLM only gets the rest
+            if os.environ.get('GROUP2_3_RULES', 'True') == 'True':
+                answer, df_gp2, df_gp3 = resolve_group2_3(df_gp2, df_gp3, found_route, RULES_CONFIG_FILE)
+            else:
+                answer = {}
+
+            # Only run Group 2 and 3 Query if there were any ingredient found
+            if (df_gp2.shape[0] + df_gp3.shape[0]) > 0:
+                answer.update(query_group2_3(df_gp2, df_gp3, found_route, found_df))
+
+            result_ids_g2_3 = process_output_group2_3(answer, name2id)
+            _stages['group2_3'] = {'result_ids': result_ids_g2_3}
+
+        if 'group4_5' in _stages:
+            result_ids_g4, result_ids_g5 = _stages['group4_5']['result_ids_g4'], _stages['group4_5']['result_ids_g5']
+        else:
+            # Group 4 (Group 5 queries the same index)
+            _index_g4 = index_data(_doc_to_index,
                                    deployment_env_key="DEPLOYMENT_GROUP4-5",
-                                   model_env_key="MODEL_GROUP4-5")
-            answer = prepare_schema_query_g5(_index_g5, "rubber or rubber stopper or any rubber related substance", "Rubber")
-            if "Found Rubber" in answer and answer["Found Rubber"] in [1, '1']:
-                result_ids_g5.append(name2id["rubber"])
+                                   model_env_key="MODEL_GROUP4-5", cache=_index_cache, nodes=_nodes)
+            _nodes.clear()
+            query_engine, output_parser = prepare_schema_query_g4(_index_g4, df_gp4)
+            response = query_index(query_engine, _index_g4, os.environ["schema_group4_5_query"], "DEPLOYMENT_GROUP4-5",
+                                   priority=PRIORITY_GROUP4_5)
+            result_ids_g4 = process_output_group4_5(response, output_parser, name2id)
+
+            # Group 5
+            result_ids_g5 = []
+            if label.contains("latex"):
+                answer = prepare_schema_query_g5(_index_g4, "latex or any latex related substance", "Latex")
+                if "Found Latex" in answer and answer["Found Latex"] in [1, '1']:
+                    result_ids_g5.append(name2id["latex"])
+            elif label.contains("rubber"):
+                answer = prepare_schema_query_g5(_index_g4, "rubber or rubber stopper or any rubber related substance", "Rubber")
+                if "Found Rubber" in answer and answer["Found Rubber"] in [1, '1']:
+                    result_ids_g5.append(name2id["rubber"])
+            del _index_g4
+            _stages['group4_5'] = {'result_ids_g4': result_ids_g4, 'result_ids_g5': result_ids_g5}
 
         result_ids = result_ids_g1 + result_ids_g2_3 + result_ids_g4 + result_ids_g5
 
         # In case it finds any issue save to a logger file the text being used, to try to debug what's happening
         if _true_ing is not None and sorted(_true_ing) != sorted(result_ids):
             with open(f'data/parsed_texts/{_setid}_{os.environ["EXTRACT_METHOD"]}.txt', 'w+') as f:
-                f.write(whole_txt)
+                f.write(label.text)
 
         if _logger is not None:
             _logger.info(f"Took overall: {print_time(time.time() - start)}\n")
@@ -2,7 +2,6 @@ from helpers.util import print_time
 import os
 import time
 import warnings
-from langchain.document_loaders import BSHTMLLoader
 
 
 def get_doc_dailymed(setid, method="xml", _logger=None):
@@ -131,10 +130,11 @@ def extract_xml(filename, method):
     document_xml : llama_index.schema.Document
         the Document object
     """
-    from langchain.document_loaders import UnstructuredXMLLoader
     from llama_index import Document
 
     if method == '1':
+        from langchain.document_loaders import UnstructuredXMLLoader
+
         loader = UnstructuredXMLLoader(filename)
         docs = loader.load()
         txt = docs[0].page_content
@@ -152,6 +152,8 @@ def extract_xml(filename, method):
         document_xml = Document(text=txt)
         
     elif method == '3':
+        from langchain.document_loaders import BSHTMLLoader
+
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
             loader = BSHTMLLoader(filename, bs_kwargs={'features': 'html5lib'})
@@ -183,9 +185,6 @@ def extract_doc_content(doc_filename, _logger=None):
         the Document object
     """
 
-    from pathlib import Path
-    from llama_index import download_loader
-
     content, index = "", None
     document_xml, document_pdf = None, None
     
@@ -212,6 +211,9 @@ def extract_doc_content(doc_filename, _logger=None):
             content_xml, document_xml = extract_xml(doc_filename_xml, os.environ['XML_EXTRACTION'])
 
         if method_pdf:
+            from pathlib import Path
+            from llama_index import download_loader
+
             PDFReader = download_loader("PDFReader")
 
             loader = PDFReader()
@@ -249,3 +251,49 @@ def extract_doc_content(doc_filename, _logger=None):
             print(f'Took overall: {print_time(time.time() - start)}\n')
 
         return None
+
+
+class LabelText:
+    """ Text of a label built once from its documents, with a lower-cased whitespace-normalized view and the set of
+    its words, shared by all the keyword pre-screens of the extraction (ink, latex, rubber, aliases)
+    """
+
+    def __init__(self, documents, text=None):
+        import re
+
+        self.text = "\n".join([d.text for d in documents]) if text is None else text
+        self.lower = " ".join(self.text.lower().split())
+        self.terms = frozenset(re.findall(r"[a-z0-9]+", self.lower))
+
+    def contains(self, txt):
+        """ Whether the text (lower cased) appears anywhere in the label, ex: 'latex' also matches 'latex-free'
+        """
+        return " ".join(txt.lower().split()) in self.lower
+
+    def has_words(self, txt):
+        """ Whether the words of the text appear in the label as a sequence of whole words, ex: 'ink' doesn't match
+        'drinking'. Labels missing one of the words are discarded through the word set without scanning the text
+        """
+        import re
+
+        words = re.findall(r"[a-z0-9]+", txt.lower())
+        if len(words) == 0 or any([w not in self.terms for w in words]):
+            return False
+
+        return re.search(r"\b" + r"\W+".join(words) + r"\b", self.lower) is not None
+
+    def section(self, headings, window=1000):
+        """ Text following each occurrence of the headings (ex: 'inactive ingredient') up to window characters, as a
+        LabelText of its own (empty when the label has none of the headings)
+        """
+        import re
+
+        spans = []
+        for m in re.finditer("|".join([re.escape(" ".join(h.lower().split())) for h in headings]), self.lower):
+            # overlapping windows (ex: heading repeated in the section) are merged
+            if len(spans) > 0 and m.start() <= spans[-1][1]:
+                spans[-1][1] = m.start() + window
+            else:
+                spans.append([m.start(), m.start() + window])
+
+        return LabelText([], text=" ".join([self.lower[start:end] for start, end in spans]))
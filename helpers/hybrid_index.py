@@ -0,0 +1,105 @@
+import math
+import re
+from collections import Counter
+from llama_index.indices.base_retriever import BaseRetriever
+from llama_index.schema import NodeWithScore
+from helpers.config import DEFAULT_TOP_K
+
+# added to the keyword queries of Group 1, so the chunks of the ingredient sections rank first among the exact name
+# matches (Group 4-5 substances are looked for anywhere in the narrative text)
+SECTION_TERMS = ["inactive", "ingredients", "excipients", "contains"]
+RRF_K = 60
+
+
+def tokenize(txt):
+    """ Lower cased words and numbers of a text, chemical names are kept whole (ex: 'FD&C Red No. 40' gives 'fd', 'c',
+    'red', 'no', '40')
+    """
+    return re.findall(r"[a-z0-9]+", txt.lower())
+
+
+class BM25:
+    """ Okapi BM25 inverted index over the text of some nodes, built locally (no LLM or embedding call)
+    """
+
+    def __init__(self, texts, k1=1.5, b=0.75):
+        self.k1, self.b = k1, b
+        self.term_freqs = [Counter(tokenize(t)) for t in texts]
+        self.lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_length = sum(self.lengths) / max(len(self.lengths), 1)
+
+        postings = {}
+        for i, tf in enumerate(self.term_freqs):
+            for term in tf:
+                postings.setdefault(term, []).append(i)
+        self.postings = postings
+        self.idf = {term: math.log(1 + (len(texts) - len(docs) + 0.5) / (len(docs) + 0.5))
+                    for term, docs in postings.items()}
+
+    def scores(self, query_terms):
+        """ BM25 score of every node for the query terms (only the nodes containing a term are scored)
+        """
+        scores = [0.0] * len(self.term_freqs)
+        for term in set(query_terms):
+            for i in self.postings.get(term, []):
+                tf = self.term_freqs[i][term]
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / max(self.avg_length, 1))
+                scores[i] += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+
+        return scores
+
+
+class HybridRetriever(BaseRetriever):
+    """ Nodes retrieved by the vector index and by BM25, fused with reciprocal rank fusion
+    """
+
+    def __init__(self, vector_index, bm25, nodes, similarity_top_k=DEFAULT_TOP_K, section_terms=()):
+        super().__init__()
+        self._vector_index = vector_index
+        self._bm25 = bm25
+        self._nodes = nodes
+        self._top_k = similarity_top_k
+        self._section_terms = list(section_terms)
+
+    def _retrieve(self, query_bundle):
+        candidates = max(self._top_k * 5, 10)
+
+        ranked = {}
+        vector_nodes = self._vector_index.as_retriever(similarity_top_k=candidates).retrieve(query_bundle)
+        for rank, node in enumerate(vector_nodes):
+            ranked[node.node.node_id] = [node.node, 1 / (RRF_K + rank + 1)]
+
+        scores = self._bm25.scores(tokenize(query_bundle.query_str) + self._section_terms)
+        keyword_order = sorted([i for i, s in enumerate(scores) if s > 0], key=lambda i: -scores[i])[:candidates]
+        for rank, i in enumerate(keyword_order):
+            node = self._nodes[i]
+            ranked.setdefault(node.node_id, [node, 0])[1] += 1 / (RRF_K + rank + 1)
+
+        fused = sorted(ranked.values(), key=lambda x: -x[1])[:self._top_k]
+        return [NodeWithScore(node=node, score=score) for node, score in fused]
+
+
+class HybridIndex:
+    """ Vector index along with a BM25 index of the same nodes, queried through HybridRetriever. Exposes what the
+    extraction uses from an index (as_retriever, as_query_engine, docstore, storage_context). With section_terms the
+    keyword queries favour the ingredient sections (SECTION_TERMS, for the Group 1 queries)
+    """
+
+    def __init__(self, vector_index, section_terms=False):
+        self.vector_index = vector_index
+        self.section_terms = SECTION_TERMS if section_terms else []
+        self.service_context = vector_index.service_context
+        self.storage_context = vector_index.storage_context
+        self.docstore = vector_index.docstore
+        self.nodes = list(self.docstore.docs.values())
+        self.bm25 = BM25([n.get_content() for n in self.nodes])
+
+    def as_retriever(self, similarity_top_k=DEFAULT_TOP_K, **kwargs):
+        return HybridRetriever(self.vector_index, self.bm25, self.nodes, similarity_top_k=similarity_top_k,
+                               section_terms=self.section_terms)
+
+    def as_query_engine(self, similarity_top_k=DEFAULT_TOP_K, **kwargs):
+        from llama_index.query_engine import RetrieverQueryEngine
+
+        return RetrieverQueryEngine.from_args(self.as_retriever(similarity_top_k), service_context=self.service_context,
+                                              **kwargs)
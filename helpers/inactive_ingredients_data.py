@@ -1,9 +1,50 @@
 import pandas as pd
+from functools import lru_cache
+from helpers.ndc_store import get_ndc_store, lookup_reported_inactive, lookup_spl_by_raw_ndc, lookup_spl_by_setid, \
+    lookup_truth
 
 DEFAULT_INACTIVE_CSV, DEFAULT_ALIAS_CSV = "data/LLM03_RI.txt", "data/LLM04_RI_ALIAS.txt"
 DEFAULT_DESC_FIELD = 'FDB_HICDDESC'
 
 
+@lru_cache(maxsize=None)
+def read_reference_csv(filename):
+    """ Read a reference CSV only once per process. The returned DataFrame is shared between callers, so it must be
+    treated as read-only (filter it with .loc or copy it before changing it). When the data is loaded before forking
+    worker processes, the workers inherit it instead of parsing the CSV again.
+
+    Parameters
+    ----------
+    filename : str
+        path of the reference CSV file
+
+    Returns
+    -------
+    pandas.DataFrame
+        content of the CSV file
+    """
+    return pd.read_csv(filename)
+
+
+def preload_reference_data(root="data/"):
+    """ Load all reference CSV files into the process cache (see read_reference_csv), to be called before
+    creating worker processes so they share the parsed tables
+
+    Parameters
+    ----------
+    root : str
+        Root path for where CSV files are located
+
+    Returns
+    -------
+    None
+    """
+    get_data(root=root)
+    read_reference_csv(DEFAULT_INACTIVE_CSV)
+    read_reference_csv(DEFAULT_ALIAS_CSV)
+    unii_index(DEFAULT_ALIAS_CSV)
+
+
 def get_data(root=""):
     """ Get the data from the SPL which is in the provided CSV files:
     ( LLM01_NDCSPL.txt | LLM02_NDCRI.txt | LLM03_RI.txt | LLM04_RI_ALIAS.txt)
@@ -27,14 +68,12 @@ def get_data(root=""):
         Aliases of Inactive Ingredients
     """
 
-    import pandas as pd
-
     # Original description:
     #   CSV file that maps an NDC to the SPL used. NDC is represented as both NDC11 and RawNDC.
     #   (NDC11, RawNDC, ProprietaryName, DocID, SetID, FileRevisionNumber, S3Key)
     # Joao description:
     #   CSV containing info on products (product codes and version of label, path to XML)
-    ndc2spl = pd.read_csv(root + 'LLM01_NDCSPL.txt')
+    ndc2spl = read_reference_csv(root + 'LLM01_NDCSPL.txt')
 
     # Original description:
     #   CSV file listing ingredients for all supported NDCs as of 7/14/2023. Ingredient is represented by HICSEQNO and
@@ -43,7 +82,7 @@ def get_data(root=""):
     #   (NDC11, HICSEQNO, ReportedInactiveID, Note)
     # Joao description:
     #   The Inactive Ingredients contained in each Product
-    ndc2ri = pd.read_csv(root + 'LLM02_NDCRI.txt')
+    ndc2ri = read_reference_csv(root + 'LLM02_NDCRI.txt')
 
     # Original description:
     #   CSV file of the 83 "reported inactives" and their IDs and definitions. Includes frequency of use and "complexity
@@ -51,12 +90,12 @@ def get_data(root=""):
     #   GroupDescription, Discussion)
     # Joao description:
     #   Information on Inactive ingredients (it's description grouping, ...)
-    ri = pd.read_csv(root + 'LLM03_RI.txt')
+    ri = read_reference_csv(root + 'LLM03_RI.txt')
 
     # Original Description:
     #   CSV file listing the aliases (synonyms) of each of the ingredients. (ReportedInactiveID, Alias, AliasType)
     #
-    ri2alias = pd.read_csv(root + 'LLM04_RI_ALIAS.txt')
+    ri2alias = read_reference_csv(root + 'LLM04_RI_ALIAS.txt')
 
     return ndc2spl, ndc2ri, ri, ri2alias
 
@@ -81,13 +120,35 @@ def get_todd_ingredients(_search, _ndc_setid, ndc11, filter_group=None):
         IDs found in Todd's rules which correspond at the moment to the "true" labels
     """
 
-    _ndc2spl, _ndc2ri, _ri, _ = get_data(root="data/")
+    store = get_ndc_store()
+    if store is not None:
+        _ri = read_reference_csv('data/LLM03_RI.txt')
+    else:
+        _ndc2spl, _ndc2ri, _ri, _ = get_data(root="data/")
 
     if filter_group is not None:
         valid_inactive_ids = _ri.loc[_ri.GroupNumber.isin(filter_group), 'ReportedInactiveID'].values.tolist()
     else:
         valid_inactive_ids = _ri.ReportedInactiveID.values.tolist()
 
+    if store is not None and 'truth_bits' in store and (_ndc_setid == 'ndc' or 'truth_setid' in store):
+        truth, ri_ids = lookup_truth(store, [_search if _ndc_setid == 'setid' else ndc11], _ndc_setid)
+
+        return [int(i) for i in ri_ids[truth[0]] if i in valid_inactive_ids]
+
+    if store is not None:
+        if _ndc_setid == 'setid' and 'spl_ndc11' in store:
+            ndc_list = store['spl_ndc11'][lookup_spl_by_setid(store, _search)]
+        elif _ndc_setid == 'setid':
+            # a store built without LLM01_NDCSPL.txt has no NDC to SPL table
+            _ndc2spl = read_reference_csv('data/LLM01_NDCSPL.txt')
+            ndc_list = _ndc2spl.loc[_ndc2spl.SetID == _search, 'NDC11'].values.tolist()
+        else:
+            ndc_list = [ndc11]
+        rep_inactive_id = lookup_reported_inactive(store, ndc_list)
+
+        return [int(i) for i in pd.unique(rep_inactive_id) if i in valid_inactive_ids]
+
     if _ndc_setid == 'setid':
         ndc_list = _ndc2spl.loc[_ndc2spl.SetID == _search, 'NDC11'].values.tolist()
     else:
@@ -131,14 +192,12 @@ def possible_inactive_ingredients(filename_inactive=DEFAULT_INACTIVE_CSV, filena
         dictionary containing (inactive ingredient id):(inactive ingredient)
     """
 
-    import pandas as pd
-
     if logger:
         logger.info(f"Starting to load inactive ingredients.")
 
     try:
-        inactive = pd.read_csv(filename_inactive)
-        alias = pd.read_csv(filename_alias)
+        inactive = read_reference_csv(filename_inactive)
+        alias = read_reference_csv(filename_alias)
 
         if filter_group:
             inactive = inactive.loc[inactive.GroupNumber.isin(filter_group)]
@@ -177,8 +236,33 @@ def possible_inactive_ingredients(filename_inactive=DEFAULT_INACTIVE_CSV, filena
         return None, None, None, None
 
 
+@lru_cache(maxsize=None)
+def unii_index(filename_alias=DEFAULT_ALIAS_CSV):
+    """ Hash index of the UNII aliases (AliasType=UNII) of the reported inactive ingredients, to match the ingredients
+    coded in the SPL without going through the names
+
+    Parameters
+    ----------
+    filename_alias : str
+        file containing alias from inactive ingredients
+
+    Returns
+    -------
+    dict
+        dictionary containing (UNII code, upper case):(set of ReportedInactiveIDs)
+    """
+    alias = read_reference_csv(filename_alias)
+    alias = alias.loc[alias.AliasType == 'UNII']
+
+    index = {}
+    for ri_id, unii in alias[['ReportedInactiveID', 'Alias']].values.tolist():
+        index.setdefault(str(unii).strip().upper(), set()).add(int(ri_id))
+
+    return index
+
+
 def get_set_id_from_ndc(ndc):
-    """ Get the set ID of the product from a RAW NDC
+    """ Get the set ID of the product from a RAW NDC (raises a ValueError if the NDC isn't in the NDC to SPL table)
 
     Parameters
     ----------
@@ -195,9 +279,24 @@ def get_set_id_from_ndc(ndc):
         NDC value to search for
 
     """
-    _ndc2spl = pd.read_csv('data/LLM01_NDCSPL.txt')
-    setid = _ndc2spl.loc[_ndc2spl.RawNDC == ndc, 'SetID'].iloc[0]
-    ndc11 = _ndc2spl.loc[_ndc2spl.RawNDC == ndc, 'NDC11'].iloc[0]
+    store = get_ndc_store()
+    # a store built without LLM01_NDCSPL.txt has no NDC to SPL table
+    if store is not None and 'spl_order_rawndc' in store:
+        row = lookup_spl_by_raw_ndc(store, ndc)
+        if row is None:
+            raise ValueError(f"NDC {ndc} not found in the NDC to SPL table")
+        setid = store['spl_setid'][row].decode()
+        ndc11 = int(store['spl_ndc11'][row])
+        ndcs = [n.decode() for n in store['spl_rawndc'][lookup_spl_by_setid(store, setid)]]
+
+        return setid, ndcs, ndc11
+
+    _ndc2spl = read_reference_csv('data/LLM01_NDCSPL.txt')
+    rows = _ndc2spl.loc[_ndc2spl.RawNDC == ndc]
+    if rows.shape[0] == 0:
+        raise ValueError(f"NDC {ndc} not found in the NDC to SPL table")
+    setid = rows['SetID'].iloc[0]
+    ndc11 = rows['NDC11'].iloc[0]
     ndcs = _ndc2spl.loc[_ndc2spl.SetID == setid, 'RawNDC'].tolist()
 
     return setid, ndcs, ndc11
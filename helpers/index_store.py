@@ -0,0 +1,180 @@
+import hashlib
+import os
+import shutil
+import time
+
+# bumped whenever the chunking or the persisted layout changes, so older indexes are not loaded
+INDEX_STORE_VERSION = "1"
+
+
+def get_index_store_dir():
+    """ Folder of the persisted vector indexes, configured through the INDEX_STORE_DIR environment variable (empty or
+    unset means the indexes are only kept in memory)
+    """
+    return os.environ.get('INDEX_STORE_DIR', '')
+
+
+def embedding_name():
+    """ Name of the embedding model used by the vector indexes (the embeddings of one model can't be queried with
+    another)
+    """
+    if os.environ.get('LOCAL_EMBEDDINGS_MODEL', '') != '':
+        return f"local:{os.environ['LOCAL_EMBEDDINGS_MODEL']}"
+    if os.environ.get('OPENAI_USE_EMBEDDINGS', 'False') == 'True':
+        return os.environ.get('OPENAI_EMBEDDINGS_MODEL', '')
+    return 'default'
+
+
+def index_key(doc_to_index):
+    """ Key of the persisted index of some documents: hash of their text and of the embedding model. The text of an
+    SPL only changes with its revision, so a new revision of a label gets a new index and any worker or run indexing
+    the same revision finds it
+
+    Parameters
+    ----------
+    doc_to_index : list
+        Llama Documents indexed
+
+    Returns
+    -------
+    str
+        sha256 hex digest
+    """
+    h = hashlib.sha256(f"{INDEX_STORE_VERSION}|{embedding_name()}".encode())
+    for d in doc_to_index:
+        h.update(b"\0" + d.text.encode())
+
+    return h.hexdigest()
+
+
+def load_persisted_index(doc_to_index, service_context):
+    """ Vector index of the documents persisted by an earlier run or worker
+
+    Parameters
+    ----------
+    doc_to_index : list
+        Llama Documents indexed
+    service_context : llama_index.indices.service_context.ServiceContext
+        service context used to query the index (the LLM isn't part of the persisted index)
+
+    Returns
+    -------
+    llama_index.indices.base.BaseIndex
+        the index, or None when the store isn't configured or the index wasn't persisted yet
+    """
+    store_dir = get_index_store_dir()
+    if store_dir == '':
+        return None
+
+    index_dir = os.path.join(store_dir, index_key(doc_to_index))
+    if not os.path.isdir(index_dir):
+        return None
+
+    try:
+        from llama_index import StorageContext, load_index_from_storage
+
+        index = load_index_from_storage(StorageContext.from_defaults(persist_dir=index_dir),
+                                        service_context=service_context)
+        # last use, compaction removes the indexes unused for the longest time first
+        os.utime(index_dir)
+        return index
+    except Exception as e:
+        print(f"Error loading the persisted index {index_dir}. Error: '{e.__str__()}'")
+        return None
+
+
+def persist_index(index, doc_to_index):
+    """ Save the vector index of the documents in the store. It is written to its own temporary folder first then
+    renamed, so the workers never load a partially written index (when two threads or workers index the same label,
+    the first one renamed wins and the others are dropped)
+
+    Parameters
+    ----------
+    index : llama_index.indices.base.BaseIndex
+        index to persist
+    doc_to_index : list
+        Llama Documents indexed
+    """
+    store_dir = get_index_store_dir()
+    if store_dir == '' or index is None:
+        return
+
+    import tempfile
+
+    key = index_key(doc_to_index)
+    index_dir = os.path.join(store_dir, key)
+    if os.path.isdir(index_dir):
+        return
+
+    tmp_dir = None
+    try:
+        os.makedirs(store_dir, exist_ok=True)
+        # unique per call, the extraction threads of a process may persist the same label at the same time
+        tmp_dir = tempfile.mkdtemp(prefix=f"{key}.", suffix='.tmp', dir=store_dir)
+        index.storage_context.persist(persist_dir=tmp_dir)
+        if not os.path.isdir(index_dir):
+            os.rename(tmp_dir, index_dir)
+    except Exception as e:
+        if not os.path.isdir(index_dir):
+            print(f"Error persisting the index {index_dir}. Error: '{e.__str__()}'")
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def compact_index_store(store_dir=None, max_mb=None, max_age_days=None):
+    """ Remove persisted indexes: those unused for more than max_age_days, then the least recently used ones until the
+    store fits in max_mb, as well as the temporary folders left by interrupted workers
+
+    Parameters
+    ----------
+    store_dir : str
+        folder of the store (defaults to INDEX_STORE_DIR)
+    max_mb : float
+        maximum size of the store in MB (defaults to INDEX_STORE_MAX_MB, 0 or unset for no limit)
+    max_age_days : float
+        maximum days since the last use of an index (defaults to INDEX_STORE_MAX_AGE_DAYS, 0 or unset for no limit)
+
+    Returns
+    -------
+    int
+        number of indexes removed
+    """
+    store_dir = store_dir or get_index_store_dir()
+    max_mb = float(os.environ.get('INDEX_STORE_MAX_MB', '0') or 0) if max_mb is None else max_mb
+    max_age_days = float(os.environ.get('INDEX_STORE_MAX_AGE_DAYS', '0') or 0) if max_age_days is None \
+        else max_age_days
+    if store_dir == '' or not os.path.isdir(store_dir):
+        return 0
+
+    indexes = []
+    for name in os.listdir(store_dir):
+        path = os.path.join(store_dir, name)
+        if not os.path.isdir(path):
+            continue
+        if name.endswith('.tmp'):
+            # only the ones old enough to not belong to a running worker
+            if time.time() - os.path.getmtime(path) > 60 * 60:
+                shutil.rmtree(path, ignore_errors=True)
+            continue
+        size = sum([os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)])
+        indexes.append((os.path.getmtime(path), size, path))
+
+    # least recently used first
+    indexes.sort()
+    total_size = sum([size for _, size, _ in indexes])
+    removed = 0
+    for mtime, size, path in indexes:
+        too_old = max_age_days > 0 and time.time() - mtime > max_age_days * 24 * 60 * 60
+        too_big = max_mb > 0 and total_size > max_mb * 1024 * 1024
+        if not too_old and not too_big:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+        removed += 1
+
+    return removed
+
+
+if __name__ == '__main__':
+    print(f"Removed {compact_index_store()} indexes")
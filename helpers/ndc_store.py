@@ -0,0 +1,219 @@
+import os
+import numpy as np
+from functools import lru_cache
+
+DEFAULT_NDC_STORE_DIR = "data/ndc_store/"
+
+# fixed width columns, so every array can be memory mapped
+SPL_STRING_COLUMNS = {'RawNDC': 'S16', 'DocID': 'S36', 'SetID': 'S36'}
+
+
+def build_ndc_store(root="data/", out_dir=DEFAULT_NDC_STORE_DIR):
+    """ One time conversion of the NDC reference tables (LLM02_NDCRI.txt and, when available, LLM01_NDCSPL.txt) from
+    quoted CSV into sorted numpy arrays (one .npy file per column) which are memory mapped when loaded.
+    NDC11 is integer encoded and the rows are sorted by it, so lookups are binary searches. The ground truth is also
+    saved as a bitset matrix (NDC11 x ReportedInactiveID, and its SetID rollup) for scoring whole runs at once.
+
+    Parameters
+    ----------
+    root : str
+        Root path for where CSV files are located
+    out_dir : str
+        folder where to save the arrays
+
+    Returns
+    -------
+    None
+    """
+    import pandas as pd
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    ndc2ri = pd.read_csv(root + 'LLM02_NDCRI.txt', dtype={'NDC11': str, 'HICSEQNO': str})
+    ndc2ri = ndc2ri.assign(NDC11=ndc2ri.NDC11.astype(np.int64)).sort_values(['NDC11', 'ReportedInactiveID'])
+    np.save(os.path.join(out_dir, 'ri_ndc11.npy'), ndc2ri.NDC11.values.astype(np.int64))
+    np.save(os.path.join(out_dir, 'ri_hicseqno.npy'), ndc2ri.HICSEQNO.fillna('-1').astype(np.int32).values)
+    np.save(os.path.join(out_dir, 'ri_id.npy'), ndc2ri.ReportedInactiveID.values.astype(np.int16))
+
+    # ground truth as a bitset matrix: one row per NDC11, one bit per Reported Inactive ID
+    truth_ri_ids = np.unique(np.concatenate([ndc2ri.ReportedInactiveID.values,
+                                             pd.read_csv(root + 'LLM03_RI.txt').ReportedInactiveID.values]))
+    truth_ndc11, rows = np.unique(ndc2ri.NDC11.values, return_inverse=True)
+    truth = np.zeros((len(truth_ndc11), len(truth_ri_ids)), dtype=bool)
+    truth[rows, np.searchsorted(truth_ri_ids, ndc2ri.ReportedInactiveID.values)] = True
+    np.save(os.path.join(out_dir, 'truth_ri_ids.npy'), truth_ri_ids.astype(np.int16))
+    np.save(os.path.join(out_dir, 'truth_ndc11.npy'), truth_ndc11.astype(np.int64))
+    np.save(os.path.join(out_dir, 'truth_bits.npy'), np.packbits(truth, axis=1))
+
+    if not os.path.exists(root + 'LLM01_NDCSPL.txt'):
+        return
+
+    ndc2spl = pd.read_csv(root + 'LLM01_NDCSPL.txt', dtype={'NDC11': str, 'RawNDC': str})
+    ndc2spl = ndc2spl.assign(NDC11=ndc2spl.NDC11.astype(np.int64)).sort_values('NDC11')
+    np.save(os.path.join(out_dir, 'spl_ndc11.npy'), ndc2spl.NDC11.values.astype(np.int64))
+    np.save(os.path.join(out_dir, 'spl_revision.npy'), ndc2spl.FileRevisionNumber.fillna(-1).values.astype(np.int32))
+    for column, dtype in SPL_STRING_COLUMNS.items():
+        np.save(os.path.join(out_dir, f'spl_{column.lower()}.npy'), ndc2spl[column].fillna('').values.astype(dtype))
+
+    # secondary sorted keys, with their positions in the NDC11 sorted arrays, to binary search by RawNDC or SetID
+    for column in ['RawNDC', 'SetID']:
+        values = ndc2spl[column].fillna('').values.astype(SPL_STRING_COLUMNS[column])
+        order = np.argsort(values, kind='stable')
+        np.save(os.path.join(out_dir, f'spl_sorted_{column.lower()}.npy'), values[order])
+        np.save(os.path.join(out_dir, f'spl_order_{column.lower()}.npy'), order.astype(np.int64))
+
+    # SetID rollup of the ground truth: union of the bits of all the NDCs of the SetID
+    setids = ndc2spl.SetID.fillna('').values.astype(SPL_STRING_COLUMNS['SetID'])
+    truth_setid, setid_rows = np.unique(setids, return_inverse=True)
+    positions = np.searchsorted(truth_ndc11, ndc2spl.NDC11.values)
+    has_truth = (positions < len(truth_ndc11)) & (truth_ndc11[np.minimum(positions, len(truth_ndc11) - 1)] ==
+                                                  ndc2spl.NDC11.values)
+    truth_setid_bits = np.zeros((len(truth_setid), truth.shape[1]), dtype=bool)
+    np.logical_or.at(truth_setid_bits, setid_rows[has_truth], truth[positions[has_truth]])
+    np.save(os.path.join(out_dir, 'truth_setid.npy'), truth_setid)
+    np.save(os.path.join(out_dir, 'truth_setid_bits.npy'), np.packbits(truth_setid_bits, axis=1))
+
+
+@lru_cache(maxsize=None)
+def load_ndc_store(store_dir=DEFAULT_NDC_STORE_DIR):
+    """ Load the arrays created by build_ndc_store as read only memory maps (loading takes milliseconds and the
+    pages are shared between all the workers of a node)
+
+    Parameters
+    ----------
+    store_dir : str
+        folder containing the arrays
+
+    Returns
+    -------
+    store : dict
+        dictionary with (array name): (memory mapped array)
+    """
+    return {f[:-len('.npy')]: np.load(os.path.join(store_dir, f), mmap_mode='r')
+            for f in os.listdir(store_dir) if f.endswith('.npy')}
+
+
+def get_ndc_store():
+    """ Store configured by the NDC_STORE_DIR environment variable, or None when not configured or not built yet
+
+    Returns
+    -------
+    store : dict
+        dictionary with (array name): (memory mapped array), or None
+    """
+    store_dir = os.environ.get('NDC_STORE_DIR', '')
+    if store_dir == '' or not os.path.exists(os.path.join(store_dir, 'ri_ndc11.npy')):
+        return None
+
+    return load_ndc_store(store_dir)
+
+
+def _sorted_rows(sorted_values, keys):
+    """ Positions of the rows of a sorted array which are equal to any of the keys (binary search)
+    """
+    keys = np.asarray(keys, dtype=sorted_values.dtype)
+    left = np.searchsorted(sorted_values, keys, side='left')
+    right = np.searchsorted(sorted_values, keys, side='right')
+
+    return np.concatenate([np.arange(le, ri) for le, ri in zip(left, right)] + [np.empty(0, dtype=np.int64)])
+
+
+def lookup_reported_inactive(store, ndc11_list):
+    """ Reported Inactive Ingredient IDs of a list of NDC11
+
+    Parameters
+    ----------
+    store : dict
+        store loaded with load_ndc_store
+    ndc11_list : list
+        NDC11 values (int or str) to look for
+
+    Returns
+    -------
+    ri_ids : numpy.ndarray
+        Reported Inactive Ingredient IDs of all the rows of the NDCs
+    """
+    rows = _sorted_rows(store['ri_ndc11'], [int(n) for n in ndc11_list])
+
+    return np.asarray(store['ri_id'][rows], dtype=np.int64)
+
+
+def lookup_spl_by_raw_ndc(store, raw_ndc):
+    """ Row of the NDC to SPL table corresponding to a RAW NDC
+
+    Parameters
+    ----------
+    store : dict
+        store loaded with load_ndc_store
+    raw_ndc : str
+        NDC Raw value
+
+    Returns
+    -------
+    row : int
+        position in the NDC11 sorted arrays (or None if not found)
+    """
+    order = store['spl_order_rawndc']
+    rows = _sorted_rows(store['spl_sorted_rawndc'], [raw_ndc.encode()])
+
+    return int(order[rows[0]]) if len(rows) > 0 else None
+
+
+def lookup_spl_by_setid(store, setid):
+    """ Rows of the NDC to SPL table belonging to a SetID
+
+    Parameters
+    ----------
+    store : dict
+        store loaded with load_ndc_store
+    setid : str
+        Set ID to look for
+
+    Returns
+    -------
+    rows : numpy.ndarray
+        positions in the NDC11 sorted arrays
+    """
+    order = store['spl_order_setid']
+    rows = _sorted_rows(store['spl_sorted_setid'], [setid.encode()])
+
+    return np.sort(order[rows])
+
+
+def lookup_truth(store, keys, ndc_setid='ndc'):
+    """ Ground truth (Todd's rules) of a list of NDC11 or SetIDs as a boolean matrix, in a single vectorized lookup
+
+    Parameters
+    ----------
+    store : dict
+        store loaded with load_ndc_store
+    keys : list
+        NDC11 values (int or str) or SetIDs
+    ndc_setid : str
+        Whether the keys are NDC11 or SetIDs (value: 'ndc' or 'setid')
+
+    Returns
+    -------
+    truth : numpy.ndarray
+        truth[i, j] is True when keys[i] has the ingredient ri_ids[j] (all False for unknown keys)
+    ri_ids : numpy.ndarray
+        Reported Inactive IDs of the columns
+    """
+    if ndc_setid == 'setid':
+        sorted_keys, bits = store['truth_setid'], store['truth_setid_bits']
+        keys = np.asarray([k.encode() for k in keys], dtype=sorted_keys.dtype)
+    else:
+        sorted_keys, bits = store['truth_ndc11'], store['truth_bits']
+        keys = np.asarray([int(k) for k in keys], dtype=np.int64)
+    ri_ids = np.asarray(store['truth_ri_ids'], dtype=np.int64)
+
+    positions = np.minimum(np.searchsorted(sorted_keys, keys), max(len(sorted_keys) - 1, 0))
+    found = (len(sorted_keys) > 0) & (sorted_keys[positions] == keys)
+    truth = np.unpackbits(bits[positions], axis=1, count=len(ri_ids)).astype(bool)
+    truth[~found] = False
+
+    return truth, ri_ids
+
+
+if __name__ == '__main__':
+    build_ndc_store(out_dir=os.environ.get('NDC_STORE_DIR', DEFAULT_NDC_STORE_DIR))
@@ -0,0 +1,209 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from helpers.get_spl_data import get_doc_dailymed, extract_doc_content
+from helpers.inactive_ingredients_data import get_todd_ingredients, get_set_id_from_ndc, preload_reference_data
+from helpers.results_store import get_results_store, lookup_unchanged
+from helpers.spl_structured import parse_spl_products, section_hashes, inactive_section_hash
+
+
+def prepare_search(i, search, ndc_setid, filter_groups, method):
+    """ CPU bound part of processing one search (reference lookups, download and parsing of the SPL). Meant to be run
+    inside a worker process, where the reference tables are inherited from the parent process
+
+    Parameters
+    ----------
+    i : int
+        position of the search in the list of searches
+    search : str
+        SetID or RAW NDC to process
+    ndc_setid : str
+        Whether the extraction is occuring at SETID level or NDC (value: 'ndc' or 'setid')
+    filter_groups : list
+        The groups that will be looked at
+    method : str
+        extraction method used, option: "xml", "pdf", "both"
+
+    Returns
+    -------
+    item : dict
+        all the information needed to run the LLM extraction of the search, or its stored result when the SPL
+        revision didn't change (None in case of error)
+    """
+
+    if ndc_setid == 'ndc':
+        setid, ndcs, ndc11 = get_set_id_from_ndc(search)
+    else:
+        setid = search
+        ndcs, ndc11 = [], ""
+
+    todd_ing_ids = get_todd_ingredients(search, ndc_setid, ndc11, filter_group=filter_groups)
+    item = {'i': i, 'search': search, 'setid': setid, 'ndcs': ndcs, 'ndc11': ndc11, 'todd_ing_ids': todd_ing_ids,
+            'filename': None, 'document': None, 'products': None}
+
+    # labels whose revision didn't change reuse the stored result (incremental mode)
+    item['revision'], item['stored'] = lookup_unchanged(search, setid)
+    if item['stored'] is not None:
+        return item
+
+    filename = get_doc_dailymed(setid, method=method)
+    if filename is None:
+        return None
+
+    document = extract_doc_content(filename)
+    if document is None:
+        return None
+
+    products = parse_spl_products(filename) if os.environ.get('SPL_STRUCTURED_DATA', 'True') == 'True' else None
+    sections = section_hashes(filename, products) if get_results_store() is not None else {}
+    item.update({'filename': filename, 'document': document, 'products': products, 'sections': sections,
+                 'inactive_section': inactive_section_hash(filename)})
+
+    return item
+
+
+def limit_worker_memory(limit_mb):
+    """ Cap the address space (RLIMIT_AS, not the resident memory) of the current parsing worker process (initializer
+    of the process pools), so the download and parsing of a very large label fails its own search with a MemoryError
+    instead of getting the whole node killed. The indexes are built and queried on the threads of the main process,
+    which isn't limited
+
+    Parameters
+    ----------
+    limit_mb : int
+        address space limit in MB (0 for no limit), must be above the address space of the main process since the
+        workers are forked from it
+    """
+    if limit_mb <= 0:
+        return
+
+    try:
+        import resource
+
+        resource.setrlimit(resource.RLIMIT_AS, (limit_mb * 1024 * 1024, resource.RLIM_INFINITY))
+    except Exception as e:
+        print(f"Error limiting the memory of the worker. Error: '{e.__str__()}'")
+
+
+def get_worker_memory_limit():
+    """ Address space limit of each parsing worker process in MB, configured through the WORKER_MEMORY_LIMIT
+    environment variable (0 or unset means no limit)
+    """
+    return int(os.environ.get('WORKER_MEMORY_LIMIT', '0') or 0)
+
+
+def run_sharded(list_searches, extract_fn, ndc_setid, filter_groups, method, workers, io_workers=None):
+    """ Run the pipeline over several processes: parsing of the SPLs runs in a process pool (one process per core)
+    while the LLM calls of the documents already parsed run on a thread pool of the main process, since they are
+    I/O bound. Reference tables (and the results store of the incremental mode) are loaded once before forking, so
+    the workers share them read-only. The address space of each parsing worker can be limited with WORKER_MEMORY_LIMIT.
+
+    Parameters
+    ----------
+    list_searches : list
+        SetIDs or RAW NDCs to process
+    extract_fn : callable
+        function called (in a thread of the main process) with the dictionary returned by prepare_search
+    ndc_setid : str
+        Whether the extraction is occuring at SETID level or NDC (value: 'ndc' or 'setid')
+    filter_groups : list
+        The groups that will be looked at
+    method : str
+        extraction method used, option: "xml", "pdf", "both"
+    workers : int
+        number of worker processes used for parsing
+    io_workers : int
+        number of concurrent LLM extractions (defaults to the number of worker processes)
+
+    Returns
+    -------
+    results : list
+        outputs of extract_fn in the same order as list_searches (None for the searches that failed)
+    """
+
+    preload_reference_data()
+    get_results_store()
+
+    # fork shares the already loaded reference data with the workers (copy on write)
+    start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+    mp_context = multiprocessing.get_context(start_method)
+
+    results = [None] * len(list_searches)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=limit_worker_memory,
+                             initargs=(get_worker_memory_limit(),)) as parse_pool, \
+            ThreadPoolExecutor(max_workers=io_workers or workers) as io_pool:
+        parse_futures = [parse_pool.submit(prepare_search, i, search, ndc_setid, filter_groups, method)
+                         for i, search in enumerate(list_searches)]
+
+        # LLM extraction starts as soon as each document is parsed
+        extract_futures = {}
+        for future in as_completed(parse_futures):
+            try:
+                item = future.result()
+            except Exception as e:
+                print(f"Error preparing search. Error: '{e.__str__()}'")
+                continue
+            if item is not None:
+                extract_futures[io_pool.submit(extract_fn, item)] = item['i']
+
+        for future in as_completed(extract_futures):
+            try:
+                results[extract_futures[future]] = future.result()
+            except Exception as e:
+                print(f"Error extracting search {list_searches[extract_futures[future]]}. Error: '{e.__str__()}'")
+
+    return results
+
+
+def prepare_searches(list_searches, ndc_setid, filter_groups, method, workers=1):
+    """ Download and parse all the searches once (ex: to run several prompt sets over them), on a process pool when
+    there are several workers
+
+    Parameters
+    ----------
+    list_searches : list
+        SetIDs or RAW NDCs to process
+    ndc_setid : str
+        Whether the extraction is occuring at SETID level or NDC (value: 'ndc' or 'setid')
+    filter_groups : list
+        The groups that will be looked at
+    method : str
+        extraction method used, option: "xml", "pdf", "both"
+    workers : int
+        number of worker processes used for parsing
+
+    Returns
+    -------
+    items : list
+        the dictionaries returned by prepare_search, in the same order as list_searches (failed searches are left out)
+    """
+    if workers <= 1:
+        items = [prepare_search(i, search, ndc_setid, filter_groups, method) for i, search in enumerate(list_searches)]
+        return [item for item in items if item is not None]
+
+    preload_reference_data()
+    get_results_store()
+
+    start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method),
+                             initializer=limit_worker_memory, initargs=(get_worker_memory_limit(),)) as parse_pool:
+        items = list(parse_pool.map(prepare_search, range(len(list_searches)), list_searches,
+                                    [ndc_setid] * len(list_searches), [filter_groups] * len(list_searches),
+                                    [method] * len(list_searches)))
+
+    return [item for item in items if item is not None]
+
+
+def get_workers():
+    """ Number of worker processes configured through the PARALLEL_WORKERS environment variable ('auto' uses all
+    the cores). 1 or unset means the sequential mode
+
+    Returns
+    -------
+    workers : int
+        number of worker processes
+    """
+    workers = os.environ.get('PARALLEL_WORKERS', '1')
+    if workers == 'auto':
+        return os.cpu_count() or 1
+    return max(int(workers or 1), 1)
@@ -1,4 +1,5 @@
 import os
+import re
 
 set_1 = {
     "qa_prompt": "What are all inactive ingredients in the entire text?",
@@ -122,15 +123,55 @@ set_4 = {
                              "substance is mentioned in any context, or '0' if a substance is not mentioned at all.",
 }
 
-if os.environ["PROMPT_SET"] == "set1":
-    for k in set_1.keys():
-        os.environ[k] = set_1[k]
-elif os.environ["PROMPT_SET"] == "set2":
-    for k in set_2.keys():
-        os.environ[k] = set_2[k]
-elif os.environ["PROMPT_SET"] == "set3":
-    for k in set_3.keys():
-        os.environ[k] = set_3[k]
-elif os.environ["PROMPT_SET"] == "set4":
-    for k in set_4.keys():
-        os.environ[k] = set_4[k]
+PROMPT_SETS = {'set1': set_1, 'set2': set_2, 'set3': set_3, 'set4': set_4}
+
+# question on the route and dosage form in the Group 1 queries (the set prompts miss a space in "DosageForm")
+ROUTE_DF_QUESTION = re.compile(r"\s*And the Route of Administration and Dosage\s*Form of the Product\?")
+
+
+def group1_query(name, ask_route_df):
+    """ Group 1 query of the selected prompt set, without the question on the route and dosage form when they are not
+    asked to the LLM (taken from the SPL instead)
+
+    Parameters
+    ----------
+    name : str
+        name of the prompt (qa_prompt, group_1_ndc_pos)
+    ask_route_df : bool
+        whether the route and dosage form are asked to the LLM
+
+    Returns
+    -------
+    str
+        the query
+    """
+    query = os.environ[name]
+    if ask_route_df:
+        return query
+
+    return ROUTE_DF_QUESTION.sub("", query)
+
+
+def apply_prompt_set(name):
+    """ Select a prompt set: its prompts are exposed through os.environ (where the schemas read them) and the prompts
+    only defined by the previously selected set are removed
+
+    Parameters
+    ----------
+    name : str
+        name of the prompt set (set1, set2, set3, set4)
+
+    Returns
+    -------
+    None
+    """
+    for prompts in PROMPT_SETS.values():
+        for k in prompts.keys():
+            os.environ.pop(k, None)
+
+    os.environ["PROMPT_SET"] = name
+    for k, v in PROMPT_SETS.get(name, {}).items():
+        os.environ[k] = v
+
+
+apply_prompt_set(os.environ["PROMPT_SET"])
@@ -0,0 +1,229 @@
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from functools import lru_cache
+from helpers.config import DEFAULT_TOP_K
+
+# Priorities of the stages (lower goes first): later stages go first so items already in flight finish
+PRIORITY_GROUP1, PRIORITY_GROUP2_3, PRIORITY_GROUP4_5, PRIORITY_EMBEDDINGS = 3, 2, 1, 2
+
+DEFAULT_OUTPUT_TOKENS = 512
+
+
+@lru_cache(maxsize=None)
+def _get_encoding():
+    """ tiktoken encoding used to estimate the tokens of a call (None if tiktoken is not installed)
+    """
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+def estimate_tokens(txt):
+    """ Estimate the number of tokens of a text
+
+    Parameters
+    ----------
+    txt : str
+        text to be sent to the model
+
+    Returns
+    -------
+    int
+        number of tokens (approximated as 4 characters per token when tiktoken is not available)
+    """
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(txt) // 4 + 1
+
+    return len(encoding.encode(txt, disallowed_special=()))
+
+
+def estimate_index_tokens(_index, query=""):
+    """ Estimate the prompt tokens of a query over an index: every node for a list index (the refine goes through all
+    of them), otherwise the largest retrieved nodes
+
+    Parameters
+    ----------
+    _index : llama_index.schema.indices
+        document index which will be queried
+    query : str
+        query sent along with the context
+
+    Returns
+    -------
+    int
+        number of prompt tokens
+    """
+    nodes_tokens = sorted([estimate_tokens(node.get_content()) for node in _index.docstore.docs.values()], reverse=True)
+    if type(_index).__name__ not in ['GPTListIndex', 'ListIndex', 'SummaryIndex']:
+        nodes_tokens = nodes_tokens[:DEFAULT_TOP_K]
+
+    return sum(nodes_tokens) + estimate_tokens(query)
+
+
+def is_rate_limit_error(e):
+    """ Whether an exception comes from the API throttling the calls (HTTP 429)
+    """
+    return type(e).__name__ == 'RateLimitError' or '429' in e.__str__() or 'rate limit' in e.__str__().lower()
+
+
+class TokenBucket:
+    """ Token bucket refilled continuously up to a per minute quota
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self.rate = float(per_minute) / 60.
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """ Seconds to wait until the amount is available (calls bigger than the bucket wait for a full bucket)
+        """
+        self._refill()
+        amount = min(amount, self.capacity)
+
+        return 0. if self.available >= amount else (amount - self.available) / self.rate
+
+    def consume(self, amount):
+        self._refill()
+        self.available -= min(amount, self.capacity)
+
+
+class LLMScheduler:
+    """ Schedules the calls to each deployment within its requests per minute (RPM_<deployment env key>) and tokens
+    per minute (TPM_<deployment env key>) quotas. Waiting calls are served by priority, and calls throttled by the
+    API anyway are retried with exponential backoff.
+    """
+
+    def __init__(self, max_retries=None, backoff=None):
+        self.max_retries = int(os.environ.get('LLM_MAX_RETRIES', 6)) if max_retries is None else max_retries
+        self.backoff = float(os.environ.get('LLM_RETRY_BACKOFF', 2.)) if backoff is None else backoff
+        self._condition = threading.Condition()
+        self._buckets = {}
+        self._queues = {}
+        self._counter = itertools.count()
+        self._metrics = {}
+
+    def _get_buckets(self, deployment_env_key):
+        if deployment_env_key not in self._buckets:
+            rpm = os.environ.get(f'RPM_{deployment_env_key}', '')
+            tpm = os.environ.get(f'TPM_{deployment_env_key}', '')
+            self._buckets[deployment_env_key] = (TokenBucket(rpm) if rpm != '' else None,
+                                                 TokenBucket(tpm) if tpm != '' else None)
+            self._queues[deployment_env_key] = []
+            self._metrics[deployment_env_key] = {'calls': 0, 'estimated_tokens': 0, 'throttled': 0,
+                                                 'throttle_wait': 0., 'retries': 0, 'errors': 0,
+                                                 'queue_depth': 0, 'max_queue_depth': 0}
+        return self._buckets[deployment_env_key]
+
+    def _acquire(self, deployment_env_key, tokens, priority):
+        """ Block until the call is the first of its deployment queue and both buckets have capacity
+        """
+        with self._condition:
+            requests_bucket, tokens_bucket = self._get_buckets(deployment_env_key)
+            queue, metrics = self._queues[deployment_env_key], self._metrics[deployment_env_key]
+            entry = (priority, next(self._counter))
+            heapq.heappush(queue, entry)
+            metrics['queue_depth'] = len(queue)
+            metrics['max_queue_depth'] = max(metrics['max_queue_depth'], len(queue))
+
+            start, throttled = time.monotonic(), False
+            while True:
+                if queue[0] == entry:
+                    wait = max(requests_bucket.wait_time(1) if requests_bucket is not None else 0.,
+                               tokens_bucket.wait_time(tokens) if tokens_bucket is not None else 0.)
+                    if wait <= 0:
+                        break
+                    throttled = True
+                    self._condition.wait(timeout=wait)
+                else:
+                    self._condition.wait()
+
+            if requests_bucket is not None:
+                requests_bucket.consume(1)
+            if tokens_bucket is not None:
+                tokens_bucket.consume(tokens)
+
+            heapq.heappop(queue)
+            metrics['queue_depth'] = len(queue)
+            metrics['calls'] += 1
+            metrics['estimated_tokens'] += tokens
+            if throttled:
+                metrics['throttled'] += 1
+                metrics['throttle_wait'] += time.monotonic() - start
+            self._condition.notify_all()
+
+    def call(self, deployment_env_key, fn, *args, prompt_tokens=0, output_tokens=DEFAULT_OUTPUT_TOKENS,
+             priority=PRIORITY_GROUP1, **kwargs):
+        """ Run a call to a deployment once it fits in its quotas
+
+        Parameters
+        ----------
+        deployment_env_key : str
+            Environment variable containing the deployment name, also used to name its quotas
+        fn : callable
+            function making the call to the model
+        args : list
+            arguments of fn
+        prompt_tokens : int
+            estimated tokens of the prompt (see estimate_tokens / estimate_index_tokens)
+        output_tokens : int
+            maximum tokens of the answer
+        priority : int
+            lower priorities are served first
+        kwargs : dict
+            keyword arguments of fn
+
+        Returns
+        -------
+        output of fn
+        """
+        tokens = prompt_tokens + output_tokens
+        for attempt in range(self.max_retries + 1):
+            self._acquire(deployment_env_key, tokens, priority)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    with self._condition:
+                        self._metrics[deployment_env_key]['errors'] += 1
+                    raise
+                with self._condition:
+                    self._metrics[deployment_env_key]['retries'] += 1
+                time.sleep(self.backoff * (2 ** attempt) * (1 + random.random()))
+
+    def metrics(self):
+        """ Copy of the metrics of each deployment (calls, estimated tokens, throttled calls and total throttle wait in
+        seconds, retries, errors, current and maximum queue depth)
+
+        Returns
+        -------
+        dict
+            dictionary with (deployment env key): (metrics)
+        """
+        with self._condition:
+            return {k: dict(v) for k, v in self._metrics.items()}
+
+
+@lru_cache(maxsize=None)
+def get_scheduler():
+    """ Scheduler shared by all the calls of the process
+
+    Returns
+    -------
+    LLMScheduler
+        the scheduler
+    """
+    return LLMScheduler()
@@ -0,0 +1,253 @@
+import json
+import os
+import threading
+from functools import lru_cache
+from helpers.inactive_ingredients_data import read_reference_csv
+from helpers.ndc_store import get_ndc_store, lookup_spl_by_setid
+
+DAILYMED_HISTORY_URL = "https://dailymed.nlm.nih.gov/dailymed/services/v2/spls/{setid}/history.json"
+MANIFEST_CSV = "data/LLM01_NDCSPL.txt"
+
+# SPL sections each stage of the extraction depends on (None means the whole label). Group 2-3 works on the Group 1
+# output, so it has the same inputs. The package label is where the product of an NDC is found.
+STAGE_SECTIONS = {'group1': ['51727-6', '34089-3', 'products'],
+                  'group2_3': ['51727-6', '34089-3', 'products'],
+                  'group4_5': None}
+NDC_STAGE_SECTIONS = ['51945-4']
+CONFIG_ENV = ['PROMPT_SET', 'SELECTED_GROUPS', 'SELECTED_ALIAS_TYPE', 'INDEXING_METHOD', 'EXTRACT_METHOD',
+              'XML_EXTRACTION', 'NDC_SETID', 'STRUCTURED_OUTPUT', 'SPL_CODED_INGREDIENTS', 'SPL_STRUCTURED_DATA',
+              'GROUP2_3_RULES']
+
+
+def config_hash():
+    """ Hash of the configuration of the run the results depend on: prompts, groups, aliases, extraction pipeline
+    (CONFIG_ENV) and the models (MODEL_* and DEPLOYMENT_* environment variables). Results of another configuration
+    can't be reused
+
+    Returns
+    -------
+    str
+        sha256 hex digest
+    """
+    import hashlib
+
+    keys = CONFIG_ENV + sorted([k for k in os.environ if k.startswith('MODEL_') or k.startswith('DEPLOYMENT_')])
+    return hashlib.sha256("|".join([f"{k}={os.environ.get(k, '')}" for k in keys]).encode()).hexdigest()
+
+
+def stage_hashes(sections, ndc_setid):
+    """ Hash of the input sections of each stage of the extraction (along with the configuration of the run)
+
+    Parameters
+    ----------
+    sections : dict
+        section hashes of the SPL (see helpers.spl_structured.section_hashes)
+    ndc_setid : str
+        Whether the extraction is occuring at SETID level or NDC (value: 'ndc' or 'setid')
+
+    Returns
+    -------
+    dict
+        dictionary with (stage): (hash of its input sections), empty when there are no section hashes
+    """
+    import hashlib
+
+    if not sections:
+        return {}
+
+    config = config_hash()
+
+    hashes = {}
+    for stage, codes in STAGE_SECTIONS.items():
+        codes = sorted(sections.keys()) if codes is None else codes + (NDC_STAGE_SECTIONS if ndc_setid == 'ndc' else [])
+        txt = config + "|" + "|".join([f"{c}:{sections.get(c, '')}" for c in codes])
+        hashes[stage] = hashlib.sha256(txt.encode()).hexdigest()
+
+    return hashes
+
+
+def get_current_revision(setid, source=None):
+    """ Current revision of the SPL of a SetID, from the local manifest (NDC store or LLM01_NDCSPL.txt
+    FileRevisionNumber) or from the DailyMed SPL history (also used when the SetID is not in the manifest)
+
+    Parameters
+    ----------
+    setid : str
+        Set ID of the SPL
+    source : str
+        'manifest' or 'dailymed' (defaults to the REVISION_SOURCE environment variable, 'manifest' if unset)
+
+    Returns
+    -------
+    revision : int
+        revision (version) number of the SPL, or None if it can't be found
+    """
+    source = source or os.environ.get('REVISION_SOURCE', 'manifest')
+
+    if source == 'manifest':
+        store = get_ndc_store()
+        if store is not None and 'spl_revision' in store:
+            rows = lookup_spl_by_setid(store, setid)
+            if len(rows) > 0:
+                return int(store['spl_revision'][rows].max())
+        elif os.path.exists(MANIFEST_CSV):
+            _ndc2spl = read_reference_csv(MANIFEST_CSV)
+            revisions = _ndc2spl.loc[_ndc2spl.SetID == setid, 'FileRevisionNumber']
+            if revisions.shape[0] > 0:
+                return int(revisions.max())
+
+    try:
+        import requests
+
+        r = requests.get(DAILYMED_HISTORY_URL.format(setid=setid), timeout=30)
+        return int(max([h['spl_version'] for h in r.json()['data']]))
+    except Exception as e:
+        print(f"Error getting the revision of {setid}. Error: '{e.__str__()}'")
+        return None
+
+
+class ResultsStore:
+    """ Results of the previous runs, saved as JSON: for each search (SetID or RAW NDC) the SPL revision it was
+    extracted from and the ingredient IDs found. Used by the incremental mode to skip the labels whose revision
+    didn't change, and, with the section hashes and stage results also stored, to only re-run the stages whose input
+    sections changed. The Group 1 stage results are also indexed by fingerprint, to be shared by the labels with the
+    same inactive ingredients section (see helpers.extraction.group1_fingerprint).
+    """
+
+    def __init__(self, filename, flush_every=100):
+        self.filename = filename
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.results = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename, encoding='utf8') as f:
+                    self.results = json.load(f)
+            except Exception as e:
+                print(f"Error loading the results store {filename}. Error: '{e.__str__()}'")
+        self._group1 = {r['stages']['group1']['fingerprint']: r['stages']['group1'] for r in self.results.values()
+                        if r.get('stages', {}).get('group1', {}).get('fingerprint')}
+
+    def get(self, search, revision):
+        """ Stored result of a search if it was extracted from the same revision with the same configuration (None
+        otherwise)
+        """
+        result = self.results.get(search)
+        if result is None or revision is None or result['revision'] != revision:
+            return None
+        if result.get('config') != config_hash():
+            return None
+        return result
+
+    def reusable_stages(self, search, sections, ndc_setid):
+        """ Stage results of the previous revision of a search whose input sections are identical in the current one,
+        extracted with the same configuration
+
+        Parameters
+        ----------
+        search : str
+            SetID or RAW NDC
+        sections : dict
+            section hashes of the current SPL (see helpers.spl_structured.section_hashes)
+        ndc_setid : str
+            Whether the extraction is occuring at SETID level or NDC (value: 'ndc' or 'setid')
+
+        Returns
+        -------
+        stages : dict
+            dictionary with (stage): (stored result of the stage), to be passed to extract_ingredients
+        """
+        result = self.results.get(search)
+        if result is None or 'stages' not in result:
+            return {}
+        # the stage hashes below are both computed with the current configuration, the stored one is checked here
+        if result.get('config') != config_hash():
+            return {}
+
+        previous, current = stage_hashes(result['sections'], ndc_setid), stage_hashes(sections, ndc_setid)
+        stages = {k: v for k, v in result['stages'].items() if k in current and previous.get(k) == current[k]}
+        # Group 2-3 decisions are made on the Group 1 output
+        if 'group1' not in stages:
+            stages.pop('group2_3', None)
+
+        return stages
+
+    def find_group1(self, fingerprint):
+        """ Stored Group 1 stage result of a label with the fingerprint (None if there is none)
+        """
+        with self._lock:
+            return self._group1.get(fingerprint)
+
+    def put(self, search, setid, revision, result_ids, product_size_ndc="", sections=None, stages=None):
+        """ Store the result of a search, with the section hashes of its SPL and the result of each stage (saved to
+        disk every flush_every results, and by save)
+        """
+        with self._lock:
+            self.results[search] = {'setid': setid, 'revision': revision, 'result_ids': [int(i) for i in result_ids],
+                                    'product_size_ndc': product_size_ndc, 'config': config_hash()}
+            if sections and stages is not None:
+                self.results[search].update({'sections': sections, 'stages': stages})
+                if stages.get('group1', {}).get('fingerprint'):
+                    self._group1[stages['group1']['fingerprint']] = stages['group1']
+            self._pending += 1
+            if self._pending >= self.flush_every:
+                self._save()
+
+    def _save(self):
+        # written to a temporary file first so an interrupted run never leaves a truncated store
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, 'w', encoding='utf8') as f:
+            json.dump(self.results, f, default=int)
+        os.replace(tmp_filename, self.filename)
+        self._pending = 0
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+
+@lru_cache(maxsize=None)
+def get_results_store():
+    """ Store configured by the RESULTS_STORE environment variable (path of the JSON file), or None when not
+    configured. Loaded once per process, worker processes forked afterwards inherit it
+
+    Returns
+    -------
+    ResultsStore
+        the results store, or None
+    """
+    filename = os.environ.get('RESULTS_STORE', '')
+    if filename == '':
+        return None
+
+    return ResultsStore(filename)
+
+
+def lookup_unchanged(search, setid):
+    """ Stored result of a search whose SPL revision didn't change since it was extracted (incremental mode, enabled
+    with INCREMENTAL=True)
+
+    Parameters
+    ----------
+    search : str
+        SetID or RAW NDC
+    setid : str
+        Set ID of the search
+
+    Returns
+    -------
+    revision : int
+        current revision of the SPL (None if it is not needed or can't be found)
+    stored : dict
+        stored result with keys setid, revision, result_ids, product_size_ndc, config (None if it must be extracted)
+    """
+    store = get_results_store()
+    if store is None:
+        return None, None
+
+    revision = get_current_revision(setid)
+    if os.environ.get('INCREMENTAL', 'False') != 'True':
+        return revision, None
+
+    return revision, store.get(search, revision)
@@ -0,0 +1,177 @@
+import re
+from functools import lru_cache
+
+# criteria which are a list of routes, ex: "systemic formulations (like: Buccal, Implant, ...)", "vaginal formulations"
+FORMULATIONS_REGEX = re.compile(r"^(?P<concept>[a-z\- ]+?) formulations\s*(?:\((?P<kind>like|example)[: ]*(?P<routes>.*)\))?$")
+# criteria on a single route, ex: "Route is Oral", "If Route is not Oral"
+ROUTE_IS_REGEX = re.compile(r"^(?:if )?route is (?P<negate>not )?(?P<route>[a-z ]+)$")
+
+
+def _split_routes(txt):
+    """ Routes of a '(like: A, B, C)' list, lower cased
+    """
+    return frozenset([r.strip() for r in txt.split(',') if r.strip() != ''])
+
+
+@lru_cache(maxsize=None)
+def compile_rules(filename):
+    """ Compile the Include / Exclude criteria of the Group 2 and 3 rules into route lookup tables. Criteria which are
+    lists of routes (or concepts defined by such a list, like 'systemic formulations') become sets of routes, any other
+    criteria (free text about dosage forms, printing ink, ...) are kept as None, meaning it needs the LLM.
+
+    Parameters
+    ----------
+    filename : str
+        path of the rules CSV (LLM05_GROUP_2-5_RULES.csv)
+
+    Returns
+    -------
+    rules : dict
+        dictionary with (rule Name): {'Include': criteria, 'Exclude': criteria}, where criteria is '' when empty,
+        None when it is free text, or a tuple (set of routes, negate)
+    known_routes : frozenset
+        all the routes mentioned in the rules
+    """
+    import pandas as pd
+
+    df = pd.read_csv(filename).fillna("")
+    df = df.loc[df.Group.isin([2, 3])]
+
+    # 1st pass: concepts defined by an explicit list of routes
+    concepts = {}
+    for criteria in df.Include.tolist() + df.Exclude.tolist():
+        m = FORMULATIONS_REGEX.match(criteria.strip().lower())
+        if m is not None and m.group('kind') == 'like':
+            concepts[m.group('concept')] = _split_routes(m.group('routes'))
+    known_routes = frozenset().union(*concepts.values())
+
+    def parse(criteria):
+        criteria = criteria.strip().lower()
+        if criteria == '':
+            return ''
+
+        m = ROUTE_IS_REGEX.match(criteria)
+        if m is not None and m.group('route').strip() in known_routes:
+            return frozenset([m.group('route').strip()]), m.group('negate') is not None
+
+        m = FORMULATIONS_REGEX.match(criteria)
+        if m is not None:
+            if m.group('concept') in concepts:
+                return concepts[m.group('concept')], False
+            if m.group('concept') in known_routes:
+                return frozenset([m.group('concept')]), False
+
+        return None
+
+    rules = {name: {'Include': parse(include), 'Exclude': parse(exclude)}
+             for name, include, exclude in df[['Name', 'Include', 'Exclude']].values.tolist()}
+
+    return rules, known_routes
+
+
+def normalize_route(route, known_routes):
+    """ Known routes mentioned in the route found for the product (ex: 'ORAL' -> {'oral'},
+    'intravenous injection' -> {'intravenous', 'injection'})
+
+    Parameters
+    ----------
+    route : str
+        route of administration of the product, several routes separated by ',', ';', '/' or 'and'
+    known_routes : frozenset
+        routes mentioned in the rules
+
+    Returns
+    -------
+    list
+        the known routes mentioned, or None when one of the routes of the product isn't known (ex: 'oral; cutaneous'),
+        the decisions on an incomplete list of routes are left to the LLM
+    """
+    found = []
+    for part in re.split(r"[,;/]|\band\b", route.lower()):
+        part = re.sub(r"[^a-z]+", " ", part).strip()
+        if part == '':
+            continue
+        part_found = [r for r in known_routes if re.search(rf"\b{r}\b", part)]
+        if len(part_found) == 0:
+            return None
+        found += [r for r in part_found if r not in found]
+
+    # multi word routes also match their words (ex: 'mucous membrane'), keep the longest ones
+    return [r for r in found if not any(r != f and r in f for f in found)]
+
+
+def _matches(criteria, route):
+    routes, negate = criteria
+    return (route in routes) != negate
+
+
+def _decide_group2(rule, route):
+    """ 'Include' / 'Exclude' decision of a Group 2 rule for a route (None if it can't be decided from the route)
+    """
+    include, exclude = rule.get('Include'), rule.get('Exclude')
+    if include not in [None, ''] and _matches(include, route):
+        return 'Include'
+    if exclude not in [None, ''] and _matches(exclude, route):
+        return 'Exclude'
+    if exclude == '' and include not in [None, '']:
+        return 'Exclude'
+    if include == '' and exclude not in [None, '']:
+        return 'Include'
+    return None
+
+
+def _decide_group3(options, rules, route):
+    """ Option of a Group 3 ingredient chosen for a route (None if it can't be decided from the route)
+    """
+    criteria = [rules.get(o, {}).get('Include') for o in options]
+    if any([c in [None, ''] for c in criteria]):
+        return None
+    chosen = [o for o, c in zip(options, criteria) if _matches(c, route)]
+
+    return chosen[0] if len(chosen) == 1 else None
+
+
+def resolve_group2_3(df_gp2, df_gp3, route, filename):
+    """ Resolve locally the Group 2 and 3 decisions whose criteria are route lists, when every known route mentioned
+    in the product route leads to the same decision. The decisions left (free text criteria, unknown or conflicting
+    routes, products with a route missing from the rules) still need the LLM.
+
+    Parameters
+    ----------
+    df_gp2 : pandas.DataFrame
+        information of the ingredients found and its rules for Group 2
+    df_gp3 : pandas.DataFrame
+        information of the ingredients found and its rules for Group 3
+    route : str
+        route of administration of the product
+    filename : str
+        path of the rules CSV
+
+    Returns
+    -------
+    answer : dict
+        resolved decisions, in the same format as the LLM answer (see process_output_group2_3)
+    df_gp2 : pandas.DataFrame
+        Group 2 rules left for the LLM
+    df_gp3 : pandas.DataFrame
+        Group 3 rules left for the LLM
+    """
+    rules, known_routes = compile_rules(filename)
+    routes = normalize_route(route, known_routes)
+    if routes is None or len(routes) == 0:
+        return {}, df_gp2, df_gp3
+
+    answer_g2, answer_g3 = {}, {}
+    for name in df_gp2.Name.tolist():
+        decisions = set([_decide_group2(rules.get(name, {}), r) for r in routes])
+        if len(decisions) == 1 and None not in decisions:
+            answer_g2[name] = decisions.pop()
+    df_gp2 = df_gp2.loc[~df_gp2.Name.isin(list(answer_g2.keys()))]
+
+    for ingredient, options in df_gp3.groupby('FDB_HICDDESC').Name:
+        decisions = set([_decide_group3(options.tolist(), rules, r) for r in routes])
+        if len(decisions) == 1 and None not in decisions:
+            answer_g3[ingredient] = decisions.pop()
+    df_gp3 = df_gp3.loc[~df_gp3.FDB_HICDDESC.isin(list(answer_g3.keys()))]
+
+    return {**answer_g2, **answer_g3}, df_gp2, df_gp3
@@ -1,89 +1,214 @@
 import os
-from langchain.chains.openai_functions import create_structured_output_chain
-from langchain.chat_models import AzureChatOpenAI
-from langchain.prompts import ChatPromptTemplate
-from llama_index import QuestionAnswerPrompt, RefinePrompt
-from llama_index.output_parsers import LangchainOutputParser
-from llama_index.prompts.default_prompts import DEFAULT_TEXT_QA_PROMPT_TMPL, DEFAULT_REFINE_PROMPT_TMPL
-from langchain.output_parsers import ResponseSchema, StructuredOutputParser
+from functools import lru_cache
+from helpers.chunk_dedup import cached_chunk_answer
+from helpers.config import configure_openai
+from helpers.rate_limit import get_scheduler, estimate_tokens, estimate_index_tokens, PRIORITY_GROUP1, \
+    PRIORITY_GROUP4_5
 
+# langchain and llama_index are imported inside the functions, so importing this module stays cheap
 
-def prepare_schema_index_query_g1_setid(_index):
-    """ Schema for extracting required information for Group 1
+
+# placeholder of the per NDC part of the Group 1 NDC schemas, filled in when the query engine is built
+SELECTED_PRODUCT = "{selected_product}"
+
+
+# JSON schema types of the langchain ResponseSchema types
+FUNCTION_TYPES = {'array': {'type': 'array', 'items': {'type': 'string'}}, 'string': {'type': 'string'},
+                  'integer': {'type': 'integer'}}
+# answers meaning nothing was found, which don't override an answer of another chunk
+EMPTY_ANSWERS = ['', 'not available', 'unknown']
+
+
+def function_schema(response_schemas):
+    """ JSON schema of a function call returning the fields of the response schemas
 
     Parameters
     ----------
-    _index : llama_index.schema.indices
-        document index which will be used to generate query engine
+    response_schemas : list
+        list of langchain ResponseSchema describing the expected answer
 
     Returns
     -------
-    query_engine : QueryEngine
-        query engine from the index
-    output_parser : StructuredOutputParser
-        parser which helps to extract the information in a structured way
+    dict
+        JSON schema of the answer
     """
+    return {
+        "title": "Extract Information",
+        "description": "Extract information from the label of a medical product",
+        "type": "object",
+        "properties": {r.name: {**FUNCTION_TYPES.get(r.type, {'type': 'string'}), "description": r.description}
+                       for r in response_schemas},
+        "required": [r.name for r in response_schemas]
+    }
 
-    found_inactive = ResponseSchema(name="FoundInactiveIngredients", type="array",
-                                    description=os.environ["schema_main_list"])
 
-    found_printing = ResponseSchema(name="IngredientsPrintingInk", type="array",
-                                    description=os.environ["schema_printing_list"])
+def merge_answers(answers, json_schema):
+    """ Merge the function call answers of several chunks of the label: union of the lists, first non empty string,
+    maximum of the integers (flags found in any chunk)
 
-    found_both_print_outside = ResponseSchema(name="IngredientsPrintingInkOutside", type="array",
-                                              description=os.environ["schema_both_print_list"])
+    Parameters
+    ----------
+    answers : list
+        answers (dictionaries) of each chunk
+    json_schema : dict
+        JSON schema of the answer (see function_schema)
 
-    product_route = ResponseSchema(name="Product_route", type="string",
-                                   description=os.environ["schema_product_route"])
+    Returns
+    -------
+    dict
+        merged answer
+    """
+    merged = {}
+    for name, prop in json_schema["properties"].items():
+        values = [a[name] for a in answers if name in a]
+        if prop['type'] == 'array':
+            values = [value if isinstance(value, list) else [value] for value in values if value is not None]
+            merged[name] = list(dict.fromkeys([v for value in values for v in value]))
+        elif prop['type'] == 'integer':
+            merged[name] = max([int(v) for v in values if str(v).strip() in ['0', '1']] + [0])
+        else:
+            found = [v for v in values if str(v).strip().lower() not in EMPTY_ANSWERS]
+            merged[name] = found[0] if len(found) > 0 else (values[0] if len(values) > 0 else '')
 
-    product_df = ResponseSchema(name="Product_dosage_form", type="string",
-                                description=os.environ["schema_product_df"])
+    return merged
 
-    mint_found = ResponseSchema(name="Product_found_mint", type="integer",
-                                description=os.environ["schema_mint_found"])
 
-    menthol_found = ResponseSchema(name="Product_found_menthol", type="integer",
-                                   description=os.environ["schema_menthol_found"])
+@lru_cache(maxsize=256)
+def _function_chain(model, deployment, schema_json):
+    """ Structured output chain of a model / deployment and a JSON schema (as sorted JSON text), built once per run
+    """
+    import json
+    from langchain.chains.openai_functions import create_structured_output_chain
+    from langchain.prompts import ChatPromptTemplate
 
-    response_schemas = [product_route, product_df, mint_found, found_inactive, found_printing, found_both_print_outside,
-                        menthol_found]
+    configure_openai()
 
-    lc_output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
-    output_parser = LangchainOutputParser(lc_output_parser)
+    if os.environ['AZURE_API'] != '':
+        from langchain.chat_models import AzureChatOpenAI
+        llm = AzureChatOpenAI(model=model, deployment_name=deployment, temperature=0)
+    else:
+        from langchain.chat_models import ChatOpenAI
+        llm = ChatOpenAI(model=model, temperature=0)
 
-    # format each prompt with output parser instructions
-    fmt_qa_tmpl = output_parser.format(DEFAULT_TEXT_QA_PROMPT_TMPL)
-    fmt_refine_tmpl = output_parser.format(DEFAULT_REFINE_PROMPT_TMPL)
-    qa_prompt = QuestionAnswerPrompt(fmt_qa_tmpl, output_parser=output_parser)
-    refine_prompt = RefinePrompt(fmt_refine_tmpl, output_parser=output_parser)
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            ("human", "You are an expert related to medical information, answering only from the label of a "
+                      "medical product."),
+            ("human", "Context information is below.\n---------------------\n{context}\n---------------------"),
+            ("human", "{query}"),
+            ("human", "Tip: Make sure to answer in the correct format"),
+        ]
+    )
 
-    query_engine = _index.as_query_engine(text_qa_template=qa_prompt, refine_template=refine_prompt)
+    return create_structured_output_chain(json.loads(schema_json), llm, prompt, verbose=False)
 
-    return query_engine, output_parser
 
+class FunctionCallingQueryEngine:
+    """ Query engine answering through OpenAI function calling, like the Group 2-3 chain: the nodes retrieved from the
+    index are sent in as few calls as fit FUNCTION_CALLING_CONTEXT_TOKENS along with the JSON schema of the answer,
+    and the answers of the calls are merged. The response is JSON text, so the output parsers work unchanged. Each
+    call goes through the scheduler of the deployment with the tokens of its own batch (see scheduled_query).
+    """
 
-def prepare_schema_index_query_g1_ndc_pre(_index, _ndcs):
-    """ Schema for extracting required information for Group 1
+    def __init__(self, _index, json_schema, deployment_env_key):
+        self._index = _index
+        self.json_schema = json_schema
+        self.deployment_env_key = deployment_env_key
+        self.context_tokens = int(os.environ.get('FUNCTION_CALLING_CONTEXT_TOKENS', 6000))
+
+    def _chain(self):
+        import json
+
+        model = os.environ[self.deployment_env_key.replace("DEPLOYMENT", "MODEL")]
+        return _function_chain(model, os.environ.get(self.deployment_env_key, model),
+                               json.dumps(self.json_schema, sort_keys=True))
+
+    def _batches(self, query):
+        """ Texts of the retrieved nodes, packed in batches within the context tokens
+        """
+        batches, current, current_tokens = [], [], 0
+        for node in self._index.as_retriever().retrieve(query):
+            txt = node.node.get_content()
+            tokens = estimate_tokens(txt)
+            if len(current) > 0 and current_tokens + tokens > self.context_tokens:
+                batches.append("\n\n".join(current))
+                current, current_tokens = [], 0
+            current.append(txt)
+            current_tokens += tokens
+        if len(current) > 0:
+            batches.append("\n\n".join(current))
+
+        return batches
+
+    def _run(self, chain, context, query, priority):
+        prompt_tokens = estimate_tokens(chain.prompt.format(context=context, query=query) + str(chain.llm_kwargs))
+        return get_scheduler().call(self.deployment_env_key, chain.run, context=context, query=query,
+                                    prompt_tokens=prompt_tokens, priority=priority)
+
+    def query(self, query, priority=PRIORITY_GROUP1):
+        import json
+        from llama_index.response.schema import Response
+
+        chain = self._chain()
+        # the exact same chunks asked the same question on another label reuse its answer
+        model = os.environ.get(self.deployment_env_key, '')
+        answers = [cached_chunk_answer(lambda c, q: self._run(chain, c, q, priority), context, query,
+                                       self.json_schema, model) for context in self._batches(query)]
+
+        return Response(response=json.dumps(merge_answers(answers, self.json_schema)))
+
+
+def scheduled_query(query_engine, _index, query, deployment_env_key, priority=PRIORITY_GROUP1):
+    """ Query an index through the rate limit aware scheduler of the deployment. A function calling engine schedules
+    each of its calls itself, otherwise the whole query is one call estimated from the index
 
     Parameters
     ----------
+    query_engine : QueryEngine
+        query engine from the index
     _index : llama_index.schema.indices
-        document index which will be used to generate query engine
-    _ndcs : list
-        list of all RAW _NDCs present in FDB for the specific SetID
+        the index queried (used to estimate the tokens of the call)
+    query : str
+        query to run
+    deployment_env_key : str
+        Environment variable containing Azure OpenAI deployment name used by the index
+    priority : int
+        priority of the call in the deployment queue (lower goes first)
+
+    Returns
+    -------
+    response : llama_index.response.schema.Response
+        response of the query engine
+    """
+    if isinstance(query_engine, FunctionCallingQueryEngine):
+        return query_engine.query(query, priority=priority)
+
+    return get_scheduler().call(deployment_env_key, query_engine.query, query,
+                                prompt_tokens=estimate_index_tokens(_index, query), priority=priority)
+
+
+def structured_prompts(response_schemas):
+    """ Output parser and QA / refine templates asking for a structured (JSON) answer
+
+    Parameters
+    ----------
+    response_schemas : list
+        list of langchain ResponseSchema describing the expected answer
 
     Returns
     -------
-    query_engine : QueryEngine
-        query engine from the index
     output_parser : StructuredOutputParser
         parser which helps to extract the information in a structured way
-
+    fmt_qa_tmpl : str
+        QA template with the output parser instructions
+    fmt_refine_tmpl : str
+        refine template with the output parser instructions
+    json_schema : dict
+        JSON schema of the answer for function calling
     """
-
-    response_schemas = [ResponseSchema(name=f"NDC {ndc} Information", type="string",
-                                       description=f"The product dosage and size for NDC {ndc}. In case you don't find any relevant information return 'Not Available'")
-                        for ndc in _ndcs]
+    from langchain.output_parsers import StructuredOutputParser
+    from llama_index.output_parsers import LangchainOutputParser
+    from llama_index.prompts.default_prompts import DEFAULT_TEXT_QA_PROMPT_TMPL, DEFAULT_REFINE_PROMPT_TMPL
 
     lc_output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
     output_parser = LangchainOutputParser(lc_output_parser)
@@ -91,23 +216,25 @@ def prepare_schema_index_query_g1_ndc_pre(_index, _ndcs):
     # format each prompt with output parser instructions
     fmt_qa_tmpl = output_parser.format(DEFAULT_TEXT_QA_PROMPT_TMPL)
     fmt_refine_tmpl = output_parser.format(DEFAULT_REFINE_PROMPT_TMPL)
-    qa_prompt = QuestionAnswerPrompt(fmt_qa_tmpl, output_parser=output_parser)
-    refine_prompt = RefinePrompt(fmt_refine_tmpl, output_parser=output_parser)
 
-    query_engine = _index.as_query_engine(text_qa_template=qa_prompt, refine_template=refine_prompt)
-
-    return query_engine, output_parser
+    return output_parser, fmt_qa_tmpl, fmt_refine_tmpl, function_schema(response_schemas)
 
 
-def prepare_schema_index_query_g1_ndc_pos(_index, selected_product):
-    """ Schema for extracting required information for Group 1
+def structured_query_engine(_index, prompts, selected_product=None, deployment_env_key=None):
+    """ Query engine of an index whose QA and refine prompts ask for a structured (JSON) answer, or which answers
+    through function calling (STRUCTURED_OUTPUT='function-calling', the default, when the deployment is given)
 
     Parameters
     ----------
     _index : llama_index.schema.indices
         document index which will be used to generate query engine
+    prompts : tuple
+        output parser and formatted templates (see structured_prompts / cached_prompts)
     selected_product : str
-        description obtained from the 1st step of the LLM containing the description of the size of the NDC
+        description of the product of the NDC replacing SELECTED_PRODUCT in the templates (or None)
+    deployment_env_key : str
+        Environment variable containing the deployment name, needed for function calling (the model comes from the
+        matching MODEL_ variable)
 
     Returns
     -------
@@ -116,9 +243,40 @@ def prepare_schema_index_query_g1_ndc_pos(_index, selected_product):
     output_parser : StructuredOutputParser
         parser which helps to extract the information in a structured way
     """
+    output_parser, fmt_qa_tmpl, fmt_refine_tmpl, json_schema = prompts
+
+    if deployment_env_key is not None and os.environ.get('STRUCTURED_OUTPUT', 'function-calling') == 'function-calling':
+        if selected_product is not None:
+            import json
+            json_schema = json.loads(json.dumps(json_schema).replace(SELECTED_PRODUCT,
+                                                                     json.dumps(selected_product)[1:-1]))
+        return FunctionCallingQueryEngine(_index, json_schema, deployment_env_key), output_parser
+
+    from llama_index import QuestionAnswerPrompt, RefinePrompt
+
+    if selected_product is not None:
+        # the instructions in the templates have their braces escaped, so has the product
+        escaped_product = selected_product.replace("{", "{{").replace("}", "}}")
+        placeholder = SELECTED_PRODUCT.replace("{", "{{").replace("}", "}}")
+        fmt_qa_tmpl = fmt_qa_tmpl.replace(placeholder, escaped_product)
+        fmt_refine_tmpl = fmt_refine_tmpl.replace(placeholder, escaped_product)
+
+    qa_prompt = QuestionAnswerPrompt(fmt_qa_tmpl, output_parser=output_parser)
+    refine_prompt = RefinePrompt(fmt_refine_tmpl, output_parser=output_parser)
+
+    query_engine = _index.as_query_engine(text_qa_template=qa_prompt, refine_template=refine_prompt)
+
+    return query_engine, output_parser
+
+
+def _schemas_g1(include_route_df, ndc_specific):
+    """ Response schemas of the Group 1 query, for the whole SPL or for the product of an NDC (SELECTED_PRODUCT)
+    """
+    from langchain.output_parsers import ResponseSchema
 
+    # the NDC descriptions keep their SELECTED_PRODUCT placeholder
     found_inactive = ResponseSchema(name="FoundInactiveIngredients", type="array",
-                                    description=os.environ["schema_ndc_list"].replace("{selected_product}", selected_product))
+                                    description=os.environ["schema_ndc_list" if ndc_specific else "schema_main_list"])
 
     found_printing = ResponseSchema(name="IngredientsPrintingInk", type="array",
                                     description=os.environ["schema_printing_list"])
@@ -138,24 +296,160 @@ def prepare_schema_index_query_g1_ndc_pos(_index, selected_product):
     menthol_found = ResponseSchema(name="Product_found_menthol", type="integer",
                                    description=os.environ["schema_menthol_found"])
 
-    ndc_specific_info = ResponseSchema(name="Found NDC Specific Information", type="integer",
-                                       description=os.environ["schema_ndc_specific"].replace("{selected_product}", selected_product))
-
     response_schemas = [product_route, product_df, mint_found, found_inactive, found_printing, found_both_print_outside,
-                        menthol_found, ndc_specific_info]
+                        menthol_found]
+    if ndc_specific:
+        response_schemas.append(ResponseSchema(name="Found NDC Specific Information", type="integer",
+                                               description=os.environ["schema_ndc_specific"]))
+    if not include_route_df:
+        response_schemas = response_schemas[2:]
 
-    lc_output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
-    output_parser = LangchainOutputParser(lc_output_parser)
+    return response_schemas
 
-    # format each prompt with output parser instructions
-    fmt_qa_tmpl = output_parser.format(DEFAULT_TEXT_QA_PROMPT_TMPL)
-    fmt_refine_tmpl = output_parser.format(DEFAULT_REFINE_PROMPT_TMPL)
-    qa_prompt = QuestionAnswerPrompt(fmt_qa_tmpl, output_parser=output_parser)
-    refine_prompt = RefinePrompt(fmt_refine_tmpl, output_parser=output_parser)
 
-    query_engine = _index.as_query_engine(text_qa_template=qa_prompt, refine_template=refine_prompt)
+def _schemas_g1_ndc_pre(ndcs):
+    """ Response schemas of the query matching each NDC of the SetID to its product
+    """
+    from langchain.output_parsers import ResponseSchema
 
-    return query_engine, output_parser
+    return [ResponseSchema(name=f"NDC {ndc} Information", type="string",
+                           description=f"The product dosage and size for NDC {ndc}. In case you don't find any relevant information return 'Not Available'")
+            for ndc in ndcs]
+
+
+def _schemas_g4(rules):
+    """ Response schemas of the Group 4 rules, rules being (Name, Include, Exclude) tuples
+    """
+    from langchain.output_parsers import ResponseSchema
+    response_schemas = []
+    for name, include, exclude in rules:
+        if exclude != '' and include != '':
+            description = f"Return '1'  if product meets the criteria: '{include}', or '0'' if product meets criteria '{exclude}'."
+        elif exclude == '':
+            description = f"Return '1' if product meets the criteria: '{include}', or '0' otherwise."
+        elif include == '':
+            description = f"Choose '0' if product meets the criteria: '{exclude}', or '1' otherwise."
+        else:
+            print('DEBUG: shouldnt have got here include-exclude group 4-5')
+            description = ""
+
+        rule = ResponseSchema(name=f"Found {name}", type="integer", description=description)
+
+        response_schemas.append(rule)
+
+    return response_schemas
+
+
+def _schemas_g5(ingredient, ingredient_name):
+    """ Response schema of the Group 5 query of an ingredient (ex: latex, rubber)
+    """
+    from langchain.output_parsers import ResponseSchema
+    desc = f"Return 1 if found mention to {ingredient}, related with substance or being a part " \
+           "of the drug formulation and any mention in any context such as in packaging components " \
+           "or in the manufacturing process. Otherwise return 0"
+
+    return [ResponseSchema(name=f"Found {ingredient_name}", type="integer", description=desc)]
+
+
+SCHEMA_VARIANTS = {'g1': _schemas_g1, 'g1_ndc_pre': _schemas_g1_ndc_pre, 'g4': _schemas_g4, 'g5': _schemas_g5}
+
+
+@lru_cache(maxsize=1024)
+def cached_prompts(prompt_set, variant, args):
+    """ Output parser and formatted templates of a schema variant, built once per (prompt set, variant, arguments /
+    rule set) instead of on every query. The descriptions are read from os.environ, so the prompt set is part of the key
+
+    Parameters
+    ----------
+    prompt_set : str
+        name of the prompt set the descriptions come from
+    variant : str
+        schema variant (key of SCHEMA_VARIANTS)
+    args : tuple
+        arguments of the schema variant (hashable, ex: the rules as (Name, Include, Exclude) tuples)
+
+    Returns
+    -------
+    tuple
+        output parser and formatted templates (see structured_prompts)
+    """
+    return structured_prompts(SCHEMA_VARIANTS[variant](*args))
+
+
+def _prompts(variant, *args):
+    return cached_prompts(os.environ.get("PROMPT_SET", ""), variant, args)
+
+
+def prepare_schema_index_query_g1_setid(_index, include_route_df=True, deployment_env_key="DEPLOYMENT_GROUP1"):
+    """ Schema for extracting required information for Group 1
+
+    Parameters
+    ----------
+    _index : llama_index.schema.indices
+        document index which will be used to generate query engine
+    include_route_df : bool
+        whether to ask for the route and dosage form (not needed when they come from the SPL structured data)
+    deployment_env_key : str
+        Environment variable containing the deployment name (used by function calling)
+
+    Returns
+    -------
+    query_engine : QueryEngine
+        query engine from the index
+    output_parser : StructuredOutputParser
+        parser which helps to extract the information in a structured way
+    """
+    return structured_query_engine(_index, _prompts('g1', include_route_df, False),
+                                   deployment_env_key=deployment_env_key)
+
+
+def prepare_schema_index_query_g1_ndc_pre(_index, _ndcs, deployment_env_key="DEPLOYMENT_GROUP1"):
+    """ Schema for extracting required information for Group 1
+
+    Parameters
+    ----------
+    _index : llama_index.schema.indices
+        document index which will be used to generate query engine
+    _ndcs : list
+        list of all RAW _NDCs present in FDB for the specific SetID
+    deployment_env_key : str
+        Environment variable containing the deployment name (used by function calling)
+
+    Returns
+    -------
+    query_engine : QueryEngine
+        query engine from the index
+    output_parser : StructuredOutputParser
+        parser which helps to extract the information in a structured way
+
+    """
+    return structured_query_engine(_index, _prompts('g1_ndc_pre', tuple(_ndcs)), deployment_env_key=deployment_env_key)
+
+
+def prepare_schema_index_query_g1_ndc_pos(_index, selected_product, include_route_df=True,
+                                          deployment_env_key="DEPLOYMENT_GROUP1-pos"):
+    """ Schema for extracting required information for Group 1
+
+    Parameters
+    ----------
+    _index : llama_index.schema.indices
+        document index which will be used to generate query engine
+    selected_product : str
+        description obtained from the 1st step of the LLM containing the description of the size of the NDC
+    include_route_df : bool
+        whether to ask for the route and dosage form (not needed when they come from the SPL structured data)
+    deployment_env_key : str
+        Environment variable containing the deployment name (used by function calling)
+
+    Returns
+    -------
+    query_engine : QueryEngine
+        query engine from the index
+    output_parser : StructuredOutputParser
+        parser which helps to extract the information in a structured way
+    """
+    return structured_query_engine(_index, _prompts('g1', include_route_df, True), selected_product=selected_product,
+                                   deployment_env_key=deployment_env_key)
 
 
 def prepare_schema_query_g2_3(df_gp2, df_gp3):
@@ -173,6 +467,12 @@ def prepare_schema_query_g2_3(df_gp2, df_gp3):
     LangChain.create_structured_output_chain
         chain prepared to execute LLM question
     """
+    from langchain.chains.openai_functions import create_structured_output_chain
+    from langchain.chat_models import AzureChatOpenAI
+    from langchain.prompts import ChatPromptTemplate
+
+    configure_openai()
+
     json_schema = {
         "title": "Extract Inactive Ingredients",
         "description": "Extract Inactive Ingredients Medical Product",
@@ -224,7 +524,7 @@ def prepare_schema_query_g2_3(df_gp2, df_gp3):
     return chain
 
 
-def prepare_schema_query_g4(_index, df):
+def prepare_schema_query_g4(_index, df, deployment_env_key="DEPLOYMENT_GROUP4-5"):
     """ Schema for extracting required information for Group 4 and 5
 
     Parameters
@@ -233,6 +533,8 @@ def prepare_schema_query_g4(_index, df):
         document index which will be used to generate query engine
     df : pandas.DataFrame
         information of the ingredients and its rules for Group 4 and 5
+    deployment_env_key : str
+        Environment variable containing the deployment name (used by function calling)
 
     Returns
     -------
@@ -241,34 +543,9 @@ def prepare_schema_query_g4(_index, df):
     output_parser : StructuredOutputParser
         parser which helps to extract the information in a structured way
     """
-    response_schemas = []
-    for name, include, exclude in df.loc[df.Include != '', ['Name', 'Include', 'Exclude']].values.tolist():
-        if exclude != '' and include != '':
-            description = f"Return '1'  if product meets the criteria: '{include}', or '0'' if product meets criteria '{exclude}'."
-        elif exclude == '':
-            description = f"Return '1' if product meets the criteria: '{include}', or '0' otherwise."
-        elif include == '':
-            description = f"Choose '0' if product meets the criteria: '{exclude}', or '1' otherwise."
-        else:
-            print('DEBUG: shouldnt have got here include-exclude group 4-5')
-            description = ""
-
-        rule = ResponseSchema(name=f"Found {name}", type="integer", description=description)
+    rules = tuple([tuple(r) for r in df.loc[df.Include != '', ['Name', 'Include', 'Exclude']].values.tolist()])
 
-        response_schemas.append(rule)
-
-    lc_output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
-    output_parser = LangchainOutputParser(lc_output_parser)
-
-    # format each prompt with output parser instructions
-    fmt_qa_tmpl = output_parser.format(DEFAULT_TEXT_QA_PROMPT_TMPL)
-    fmt_refine_tmpl = output_parser.format(DEFAULT_REFINE_PROMPT_TMPL)
-    qa_prompt = QuestionAnswerPrompt(fmt_qa_tmpl, output_parser=output_parser)
-    refine_prompt = RefinePrompt(fmt_refine_tmpl, output_parser=output_parser)
-
-    query_engine = _index.as_query_engine(text_qa_template=qa_prompt, refine_template=refine_prompt)
-
-    return query_engine, output_parser
+    return structured_query_engine(_index, _prompts('g4', rules), deployment_env_key=deployment_env_key)
 
 
 #
@@ -290,27 +567,15 @@ def prepare_schema_query_g5(_index, ingredient, ingredient_name):
         Answer from the LLM whether it found the ingredient or not '1' for found '0' for not
 
     """
-    desc = f"Return 1 if found mention to {ingredient}, related with substance or being a part " \
-           "of the drug formulation and any mention in any context such as in packaging components " \
-           "or in the manufacturing process. Otherwise return 0"
-    rule = ResponseSchema(name=f"Found {ingredient_name}", type="integer", description=desc)
-    lc_output_parser = StructuredOutputParser.from_response_schemas([rule])
-    output_parser = LangchainOutputParser(lc_output_parser)
-
-    # format each prompt with output parser instructions
-    fmt_qa_tmpl = output_parser.format(DEFAULT_TEXT_QA_PROMPT_TMPL)
-    fmt_refine_tmpl = output_parser.format(DEFAULT_REFINE_PROMPT_TMPL)
-    qa_prompt = QuestionAnswerPrompt(fmt_qa_tmpl, output_parser=output_parser)
-    refine_prompt = RefinePrompt(fmt_refine_tmpl, output_parser=output_parser)
-
-    query_engine = _index.as_query_engine(text_qa_template=qa_prompt, refine_template=refine_prompt)
+    query_engine, output_parser = structured_query_engine(_index, _prompts('g5', ingredient, ingredient_name),
+                                                          deployment_env_key="DEPLOYMENT_GROUP4-5")
     query = "Please thoroughly review the medical label. Check all " \
             "sections, including descriptions, instructions, warnings, and any other text, " \
             "for mentions of specific substances. Ensure to look for both the substance being a part " \
             "of the drug formulation and any mention in any context such as in packaging components " \
             "or in the manufacturing process. Please provide a binary output, marking '1' if a " \
             "substance is mentioned in any context, or '0' if a substance is not mentioned at all."
-    response = query_engine.query(query)
+    response = scheduled_query(query_engine, _index, query, "DEPLOYMENT_GROUP4-5", priority=PRIORITY_GROUP4_5)
     answer = output_parser.parse(response.response)
 
     return answer
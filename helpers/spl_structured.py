@@ -0,0 +1,288 @@
+import re
+
+SPL_NAMESPACE = {'v3': 'urn:hl7-org:v3'}
+NDC_CODE_SYSTEM = '2.16.840.1.113883.6.69'
+UNII_CODE_SYSTEM = '2.16.840.1.113883.4.9'
+
+
+def _display_name(element, tag):
+    """ displayName attribute of a coded child element (ex: formCode, routeCode), lower cased
+    """
+    code = element.find(f'v3:{tag}', SPL_NAMESPACE)
+    return (code.get('displayName') or '').strip().lower() if code is not None else ''
+
+
+def _ndc_code(element):
+    """ NDC code of an element (product or package), '' when it isn't coded with the NDC code system
+    """
+    code = element.find('v3:code', SPL_NAMESPACE)
+    if code is None or code.get('codeSystem') != NDC_CODE_SYSTEM:
+        return ''
+    return code.get('code', '').strip()
+
+
+def _ingredients(product, class_codes):
+    """ Ingredients of a product (and of the parts of a kit) with one of the class codes
+    """
+    ingredients = []
+    for ingredient in product.iterfind('.//v3:ingredient', SPL_NAMESPACE):
+        if ingredient.get('classCode') not in class_codes:
+            continue
+        substance = ingredient.find('v3:ingredientSubstance', SPL_NAMESPACE)
+        if substance is None:
+            continue
+        code = substance.find('v3:code', SPL_NAMESPACE)
+        unii = code.get('code', '').strip() if code is not None and code.get('codeSystem') == UNII_CODE_SYSTEM else ''
+        name = substance.findtext('v3:name', default='', namespaces=SPL_NAMESPACE).strip()
+        ingredients.append({'unii': unii, 'name': name})
+
+    return ingredients
+
+
+def _strength(product):
+    """ Strength of the active ingredients of a product, ex: 'ATORVASTATIN CALCIUM 10 mg'
+    """
+    strengths = []
+    for ingredient in product.iterfind('v3:ingredient', SPL_NAMESPACE):
+        if not (ingredient.get('classCode') or '').startswith('ACTI'):
+            continue
+        name = ingredient.findtext('v3:ingredientSubstance/v3:name', default='', namespaces=SPL_NAMESPACE).strip()
+        numerator = ingredient.find('v3:quantity/v3:numerator', SPL_NAMESPACE)
+        amount = f"{numerator.get('value', '')} {numerator.get('unit', '')}".strip() if numerator is not None else ''
+        strengths.append(f"{name} {amount}".strip())
+
+    return ", ".join([s for s in strengths if s != ''])
+
+
+def parse_spl_products(filename):
+    """ Extract the coded product data elements of an SPL XML: for each manufactured product its NDC product code,
+    dosage form (formCode), routes (routeCode), strength of the active ingredients, package NDCs
+    (containerPackagedProduct codes, all nesting levels) and inactive ingredients (ingredient classCode="IACT", with
+    UNII code)
+
+    Parameters
+    ----------
+    filename : str
+        path of the XML file of the SPL (or list of paths, the XML one is used)
+
+    Returns
+    -------
+    products : list
+        list of dictionaries with keys: name, product_ndc, form, routes, strength, package_ndcs, inactive
+        (empty list if the XML can't be parsed)
+    """
+    import xml.etree.ElementTree as ET
+
+    if isinstance(filename, list):
+        filename = next((f for f in filename if f.endswith('.xml')), None)
+    if filename is None or not filename.endswith('.xml'):
+        return []
+
+    try:
+        root = ET.parse(filename).getroot()
+    except Exception as e:
+        print(f"Error parsing SPL structured data of {filename}. Error: '{e.__str__()}'")
+        return []
+
+    products = []
+    for subject in root.iterfind('.//v3:subject/v3:manufacturedProduct', SPL_NAMESPACE):
+        product = subject.find('v3:manufacturedProduct', SPL_NAMESPACE)
+        if product is None:
+            continue
+
+        routes = [_display_name(s, 'routeCode')
+                  for s in subject.iterfind('v3:consumedIn/v3:substanceAdministration', SPL_NAMESPACE)]
+        package_ndcs = [_ndc_code(p) for p in product.iterfind('.//v3:containerPackagedProduct', SPL_NAMESPACE)]
+
+        products.append({
+            'name': product.findtext('v3:name', default='', namespaces=SPL_NAMESPACE).strip(),
+            'product_ndc': _ndc_code(product),
+            'form': _display_name(product, 'formCode'),
+            'routes': sorted(set([r for r in routes if r != ''])),
+            'strength': _strength(product),
+            'package_ndcs': [n for n in package_ndcs if n != ''],
+            'inactive': _ingredients(product, ['IACT']),
+        })
+
+    return products
+
+
+def section_hashes(filename, products=None):
+    """ Hash (sha256) of the text of each section of the SPL XML, by LOINC section code (ex: '51727-6' inactive
+    ingredient, '34089-3' description, '51945-4' package label). Nested sections are part of the text of their parent.
+    Since the coded product data isn't text, the products extracted with parse_spl_products are hashed as 'products'
+
+    Parameters
+    ----------
+    filename : str
+        path of the XML file of the SPL (or list of paths, the XML one is used)
+    products : list
+        products extracted with parse_spl_products (or None)
+
+    Returns
+    -------
+    hashes : dict
+        dictionary with (section code): (sha256 hex digest), empty if the XML can't be parsed
+    """
+    import hashlib
+    import json
+    import xml.etree.ElementTree as ET
+
+    if isinstance(filename, list):
+        filename = next((f for f in filename if f.endswith('.xml')), None)
+    if filename is None or not filename.endswith('.xml'):
+        return {}
+
+    try:
+        root = ET.parse(filename).getroot()
+    except Exception as e:
+        print(f"Error parsing SPL sections of {filename}. Error: '{e.__str__()}'")
+        return {}
+
+    hashes = {}
+    for section in root.iterfind('.//v3:section', SPL_NAMESPACE):
+        code = section.find('v3:code', SPL_NAMESPACE)
+        if code is None or code.get('code', '') == '':
+            continue
+        # whitespace only changes of the markup don't count as changes
+        txt = " ".join(" ".join(section.itertext()).split())
+        hashes.setdefault(code.get('code'), hashlib.sha256()).update(txt.encode())
+
+    hashes = {k: h.hexdigest() for k, h in hashes.items()}
+    if products is not None:
+        hashes['products'] = hashlib.sha256(json.dumps(products, sort_keys=True).encode()).hexdigest()
+
+    return hashes
+
+
+def inactive_section_hash(filename):
+    """ Hash (sha256) of the whitespace-normalized, lower cased text of the inactive ingredient section ('51727-6') of
+    the SPL XML, or of the description section ('34089-3') where the prescription labels list them. Repackagers of the
+    same manufacturer label have the same hash
+
+    Parameters
+    ----------
+    filename : str
+        path of the XML file of the SPL (or list of paths, the XML one is used)
+
+    Returns
+    -------
+    str
+        sha256 hex digest, '' when the XML can't be parsed or has none of the sections
+    """
+    import hashlib
+    import xml.etree.ElementTree as ET
+
+    if isinstance(filename, list):
+        filename = next((f for f in filename if f.endswith('.xml')), None)
+    if filename is None or not filename.endswith('.xml'):
+        return ''
+
+    try:
+        root = ET.parse(filename).getroot()
+    except Exception as e:
+        print(f"Error parsing SPL sections of {filename}. Error: '{e.__str__()}'")
+        return ''
+
+    texts = {}
+    for section in root.iterfind('.//v3:section', SPL_NAMESPACE):
+        code = section.find('v3:code', SPL_NAMESPACE)
+        if code is not None and code.get('code') in ['51727-6', '34089-3']:
+            texts.setdefault(code.get('code'), []).append(" ".join(" ".join(section.itertext()).lower().split()))
+
+    txt = texts.get('51727-6', texts.get('34089-3'))
+    return hashlib.sha256("\n".join(txt).encode()).hexdigest() if txt else ''
+
+
+def ndc_to_ndc11(ndc):
+    """ Convert a RAW NDC in any of the 10 digit formats (4-4-2, 5-3-2, 5-4-1) into NDC11 (5-4-2, no dashes)
+
+    Parameters
+    ----------
+    ndc : str
+        RAW NDC
+
+    Returns
+    -------
+    str
+        NDC11 (or only the digits if the format is unknown)
+    """
+    parts = ndc.strip().split('-')
+    if len(parts) != 3:
+        return re.sub(r"\D", "", ndc)
+
+    return parts[0].zfill(5) + parts[1].zfill(4) + parts[2].zfill(2)
+
+
+def find_product(products, ndc):
+    """ Product of the SPL which has a package with the NDC
+
+    Parameters
+    ----------
+    products : list
+        products extracted with parse_spl_products
+    ndc : str
+        RAW NDC (any format)
+
+    Returns
+    -------
+    dict
+        the product (or None if no package matches)
+    """
+    ndc11 = ndc_to_ndc11(ndc)
+    for product in products:
+        if any([ndc_to_ndc11(p) == ndc11 for p in product['package_ndcs']]):
+            return product
+
+    return None
+
+
+def describe_product(product):
+    """ Description of a product which distinguishes it from the other products of the SPL
+    (ex: 'Atorvastatin Calcium (ATORVASTATIN CALCIUM 10 mg) tablet, film coated')
+
+    Parameters
+    ----------
+    product : dict
+        product extracted with parse_spl_products
+
+    Returns
+    -------
+    str
+        description of the product
+    """
+    description = product['name']
+    if product['strength'] != '':
+        description += f" ({product['strength']})"
+    if product['form'] != '':
+        description += f" {product['form']}"
+
+    return description
+
+
+def get_route_dosage_form(products, ndc=None):
+    """ Route and dosage form of the product of an NDC, or of all the products of the SPL when no NDC is given
+    (several values are joined by comma)
+
+    Parameters
+    ----------
+    products : list
+        products extracted with parse_spl_products
+    ndc : str
+        RAW NDC, or None for the whole SPL
+
+    Returns
+    -------
+    route : str
+        Route of administration ('' if not coded)
+    dosage_form : str
+        Dosage form ('' if not coded)
+    """
+    if ndc is not None:
+        product = find_product(products, ndc)
+        products = [product] if product is not None else []
+
+    routes = sorted(set([r for p in products for r in p['routes']]))
+    forms = sorted(set([p['form'] for p in products if p['form'] != '']))
+
+    return ", ".join(routes), ", ".join(forms)
@@ -193,6 +193,7 @@ def compare_results(ids1, name1, ids2, name2, id2inactive, _logger=None, toprint
 
 def statistics(errors, config="data/LLM03_RI.txt"):
     """ Statistics function used on local validation excel to check which Group has errors, what is missing...
+    (runs of main.py are evaluated from their structured results instead, see helpers.evaluation)
 
     Parameters
     ----------
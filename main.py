@@ -3,8 +3,17 @@ from helpers.config import *
 from helpers.get_spl_data import get_doc_dailymed, extract_doc_content
 from helpers.inactive_ingredients_data import get_todd_ingredients, possible_inactive_ingredients, get_set_id_from_ndc
 from helpers.prompt import *
-from helpers.extraction import extract_ingredients
+from helpers.extraction import extract_ingredients, RETRY_STATS
+from helpers.evaluation import evaluate, format_group_metrics
+from helpers.embedding_batcher import batcher_metrics
+from helpers.index_store import compact_index_store
+from helpers.ndc_store import get_ndc_store
 from helpers.util import init_loggers, compare_results, log_session, log_init_session, print_time
+from helpers.parallel import run_sharded, prepare_searches, get_workers
+from helpers.experiment import run_experiment
+from helpers.rate_limit import get_scheduler
+from helpers.results_store import get_results_store, lookup_unchanged
+from helpers.spl_structured import parse_spl_products, section_hashes, inactive_section_hash
 # from helpers.data_sets import *
 
 list_searches = """0591-0860-01
@@ -36,11 +45,80 @@ if __name__ == '__main__':
     else:
         logger = None
 
+    inactive_ingredients, inactive2group, inactive2ids, id2inactive = possible_inactive_ingredients(filter_alias=SELECTED_ALIAS_TYPE, filter_group=SELECTED_GROUPS, logger=logger)
+
+    def run_extraction(item, _logger=None):
+        """ LLM part of processing one search, from an already parsed document (see helpers.parallel.prepare_search)
+        """
+        stages = {}
+        if item['stored'] is not None:
+            found_ingredients_ids, product = item['stored']['result_ids'], item['stored']['product_size_ndc']
+        else:
+            # stages whose sections are identical to the previous revision reuse its results
+            if results_store is not None and os.environ.get('SECTION_DIFF', 'False') == 'True':
+                stages = results_store.reusable_stages(item['search'], item['sections'], NDC_SETID)
+            found_ingredients_ids, product = extract_ingredients(item['setid'], item['search'], item['ndcs'], NDC_SETID, inactive_ingredients, inactive2group, inactive2ids, item['document'], _filter_groups=SELECTED_GROUPS, _logger=_logger, _true_ing=item['todd_ing_ids'], _spl_products=item['products'], _stages=stages, _inactive_section=item.get('inactive_section'))
+        if found_ingredients_ids is None:
+            return None
+
+        if results_store is not None and item['revision'] is not None and item['stored'] is None:
+            results_store.put(item['search'], item['setid'], item['revision'], found_ingredients_ids, product,
+                              sections=item['sections'], stages=stages)
+
+        records.append({'search': item['search'], 'setid': item['setid'], 'ndc11': item['ndc11'],
+                        'true_ids': item['todd_ing_ids'], 'found_ids': found_ingredients_ids})
+
+        compare_msg = compare_results(item['todd_ing_ids'], "ToddIngredients", found_ingredients_ids, "LLMFound", id2inactive, _logger, toprint=False)
+        log_session(log_filename, f"{item['setid']}/{item['search']}: {compare_msg}")
+
+        return compare_msg
+
+    results_store = get_results_store()
+    # structured result of each item, evaluated all at once at the end of the run
+    records = []
+
+    workers = get_workers()
+    experiment_sets = [p for p in os.environ.get('EXPERIMENT_PROMPT_SETS', '').split(',') if p != '']
+    if inactive_ingredients is None:
+        list_searches = []
+    elif len(experiment_sets) > 0:
+        # the documents are parsed once and indexed once, then each prompt set runs the LLM stages over them
+        os.environ['INCREMENTAL'] = 'False'
+
+        def run_variant(item, index_cache):
+            found_ingredients_ids, _ = extract_ingredients(item['setid'], item['search'], item['ndcs'], NDC_SETID, inactive_ingredients, inactive2group, inactive2ids, item['document'], _filter_groups=SELECTED_GROUPS, _spl_products=item['products'], _index_cache=index_cache)
+            return found_ingredients_ids
+
+        items = prepare_searches(list_searches, NDC_SETID, SELECTED_GROUPS, os.environ["EXTRACT_METHOD"], workers)
+        table = run_experiment(items, experiment_sets, run_variant, filter_group=SELECTED_GROUPS,
+                               store=get_ndc_store(), ndc_setid=NDC_SETID,
+                               io_workers=int(os.environ.get('LLM_CONCURRENCY', workers)))
+        print(table.to_string(index=False))
+        log_session(log_filename, table.to_string(index=False))
+        if log_filename is not None:
+            table.to_csv(log_filename.replace('.log', '_experiment.csv'), index=False)
+        list_searches = []
+    elif workers > 1:
+        # parsing runs on several processes and the LLM extraction of parsed documents on threads
+        def run_extraction_sharded(item):
+            compare_msg = run_extraction(item)
+            if TYPE_OF_OUTPUT == 'simple' and compare_msg is not None:
+                print(f"[{item['i']}] {item['setid']}/{item['search']}: {compare_msg}", end="")
+            return compare_msg
+
+        run_sharded(list_searches, run_extraction_sharded, NDC_SETID, SELECTED_GROUPS, os.environ["EXTRACT_METHOD"],
+                    workers, io_workers=int(os.environ.get('LLM_CONCURRENCY', workers)))
+        list_searches = []
+
     # iterated through a list of setids
     for i, search in enumerate(list_searches):
 
         if NDC_SETID == 'ndc':
-            setid, ndcs, ndc11 = get_set_id_from_ndc(search)
+            try:
+                setid, ndcs, ndc11 = get_set_id_from_ndc(search)
+            except ValueError as e:
+                print(f"[{i}] Error preparing search. Error: '{e.__str__()}'")
+                continue
         else:
             setid = search
             ndcs, ndc11 = [], ""
@@ -52,6 +130,16 @@ if __name__ == '__main__':
                 print(f'[{i}] {setid}: ', end='')
             logger = None
 
+        # labels whose revision didn't change since the previous run reuse its result
+        revision, stored = lookup_unchanged(search, setid)
+        if stored is not None:
+            item = {'i': i, 'search': search, 'setid': setid, 'ndcs': ndcs, 'ndc11': ndc11, 'revision': revision,
+                    'stored': stored, 'todd_ing_ids': get_todd_ingredients(search, NDC_SETID, ndc11, filter_group=SELECTED_GROUPS)}
+            compare_msg = run_extraction(item, _logger=logger)
+            if compare_msg is not None:
+                print(f"{compare_msg}", end="")
+            continue
+
         # Extract from Daily Med the content of the SPL of setID
         filename = get_doc_dailymed(setid, method=os.environ["EXTRACT_METHOD"], _logger=logger)
         if filename is None:
@@ -61,24 +149,36 @@ if __name__ == '__main__':
         if document is None:
             continue
 
-        inactive_ingredients, inactive2group, inactive2ids, id2inactive = possible_inactive_ingredients(filter_alias=SELECTED_ALIAS_TYPE, filter_group=SELECTED_GROUPS, logger=logger)
-        
-        if inactive_ingredients is None:
-            continue
-
         todd_ing_ids = get_todd_ingredients(search, NDC_SETID, ndc11, filter_group=SELECTED_GROUPS)
         if logger is not None:
             logger.info(f"Found Todd Ingredients: {todd_ing_ids}\n")
 
-        found_ingredients_ids, product = extract_ingredients(setid, search, ndcs, NDC_SETID, inactive_ingredients, inactive2group, inactive2ids, document, _filter_groups=SELECTED_GROUPS, _logger=logger, _true_ing=todd_ing_ids)
-        if found_ingredients_ids is None:
-            found_ingredients = ['error']
+        products = parse_spl_products(filename) if os.environ.get('SPL_STRUCTURED_DATA', 'True') == 'True' else None
+        sections = section_hashes(filename, products) if results_store is not None else {}
+
+        item = {'i': i, 'search': search, 'setid': setid, 'ndcs': ndcs, 'ndc11': ndc11, 'filename': filename,
+                'document': document, 'todd_ing_ids': todd_ing_ids, 'products': products,
+                'revision': revision, 'stored': None, 'sections': sections,
+                'inactive_section': inactive_section_hash(filename)}
+        compare_msg = run_extraction(item, _logger=logger)
+        if compare_msg is None:
             continue
 
-        compare_msg = compare_results(todd_ing_ids, "ToddIngredients", found_ingredients_ids, "LLMFound", id2inactive, logger, toprint=False)
         print(f"{compare_msg}", end="")
 
-        log_session(log_filename, f"{setid}/{search}: {compare_msg}")
+    if results_store is not None:
+        results_store.save()
+    compact_index_store()
+
+    if len(records) > 0:
+        metrics_groups, metrics_ingredients, errors = evaluate(records, filter_group=SELECTED_GROUPS,
+                                                               store=get_ndc_store(), ndc_setid=NDC_SETID)
+        for line in format_group_metrics(metrics_groups):
+            print(line)
+            log_session(log_filename, line)
+        if log_filename is not None:
+            metrics_ingredients.to_csv(log_filename.replace('.log', '_ingredients.csv'), index=False)
+            errors.to_csv(log_filename.replace('.log', '_errors.csv'), index=False)
 
     if logger is not None:
         logger.info(f"Took overall: {print_time(time.time() - start)}\n")
@@ -86,3 +186,12 @@ if __name__ == '__main__':
         print(f"Took overall: {print_time(time.time() - start)}\n")
 
     log_session(log_filename, f"Took overall: {print_time(time.time() - start)}\n")
+
+    for deployment, metrics in get_scheduler().metrics().items():
+        log_session(log_filename, f"LLM calls {deployment}: {metrics}")
+
+    for embedding, metrics in batcher_metrics().items():
+        log_session(log_filename, f"Embedding batcher {embedding}: {metrics}")
+
+    if len(RETRY_STATS) > 0:
+        log_session(log_filename, f"Group 1 retries: {dict(sorted(RETRY_STATS.items()))}")
@@ -0,0 +1,10 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# configuration read when the helpers are imported
+os.environ.setdefault('INDEXING_METHOD', 'vector-store')
+os.environ.setdefault('PROMPT_SET', 'set4')
+os.environ.setdefault('SELECTED_GROUPS', '1,2,3,4,5')
+os.environ.setdefault('SELECTED_ALIAS_TYPE', 'SYN,PT')
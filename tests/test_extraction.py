@@ -0,0 +1,61 @@
+import threading
+import time
+import pytest
+from helpers.extraction import group1_retry_reason, _memoized
+from helpers.get_spl_data import LabelText
+
+
+class Doc:
+    def __init__(self, text):
+        self.text = text
+
+
+POSSIBLE_INACTIVE = {'lactose monohydrate': ['lactose monohydrate', 'lactose'], 'water': ['water']}
+PARSED = {'parsed': True, 'raw_inactive': []}
+LABEL = LabelText([Doc("Product A 10 mg tablets. Product B oral solution.\n"
+                       "Inactive ingredients: lactose monohydrate, purified water.")])
+
+
+def test_empty_ndc_specific_answer_is_kept():
+    # the product of the NDC has no inactive ingredients, the whole label must not be asked instead
+    assert group1_retry_reason(PARSED, [], True, True, LABEL, POSSIBLE_INACTIVE) is None
+
+
+def test_ndc_answer_not_specific_is_retried():
+    assert group1_retry_reason(PARSED, [], False, True, LABEL, POSSIBLE_INACTIVE) == 'ndc_not_specific'
+
+
+def test_empty_answer_with_alias_hits_is_retried():
+    assert group1_retry_reason(PARSED, [], False, False, LABEL, POSSIBLE_INACTIVE) == 'empty_with_alias_hits'
+
+
+def test_alias_outside_inactive_section_is_ignored():
+    label = LabelText([Doc("Dissolve in water before use. " * 100 + "Inactive ingredients: talc.")])
+    assert group1_retry_reason(PARSED, [], False, False, label, POSSIBLE_INACTIVE) is None
+
+
+def test_index_cache_builds_once_across_threads():
+    cache, calls = {}, []
+
+    def build():
+        calls.append(1)
+        time.sleep(0.05)
+        return 'index'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(_memoized(cache, 'key', build))) for _ in range(8)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+    assert len(calls) == 1 and results == ['index'] * 8
+
+
+def test_index_cache_errors_not_memoized():
+    cache = {}
+
+    def fail():
+        raise RuntimeError('embedding error')
+
+    with pytest.raises(RuntimeError):
+        _memoized(cache, 'key', fail)
+    assert _memoized(cache, 'key', lambda: 'index') == 'index'
@@ -0,0 +1,41 @@
+import pytest
+from helpers.inactive_ingredients_data import get_todd_ingredients, get_set_id_from_ndc, read_reference_csv
+from helpers.ndc_store import build_ndc_store
+
+NDCRI = '"NDC11","HICSEQNO","ReportedInactiveID","Note"\n' \
+        '"00002080001","018822",170,""\n"00002080002","018822",22,""\n"00003000001","001539",5,""\n'
+RI = '"ReportedInactiveID","FDB_HICDDESC","GroupNumber"\n5,"talc",1\n22,"lactose",1\n170,"gelatin",1\n'
+NDCSPL = '"NDC11","RawNDC","SetID","FileRevisionNumber"\n' \
+         '"00002080001","0002-0800-01","setid-a",3\n"00002080002","0002-0800-02","setid-a",3\n' \
+         '"00003000001","0003-0000-01","setid-b",1\n'
+
+
+@pytest.fixture
+def store_without_spl(tmp_path, monkeypatch):
+    """ NDC store built while LLM01_NDCSPL.txt was absent, the CSV is added afterwards """
+    data = tmp_path / 'data'
+    data.mkdir()
+    (data / 'LLM02_NDCRI.txt').write_text(NDCRI)
+    (data / 'LLM03_RI.txt').write_text(RI)
+    build_ndc_store(root=str(data) + '/', out_dir=str(tmp_path / 'store'))
+    (data / 'LLM01_NDCSPL.txt').write_text(NDCSPL)
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('NDC_STORE_DIR', str(tmp_path / 'store'))
+    read_reference_csv.cache_clear()
+    yield
+    read_reference_csv.cache_clear()
+
+
+def test_todd_ingredients_setid_without_spl_table(store_without_spl):
+    assert sorted(get_todd_ingredients('setid-a', 'setid', '')) == [22, 170]
+
+
+def test_set_id_from_ndc_without_spl_table(store_without_spl):
+    setid, ndcs, ndc11 = get_set_id_from_ndc('0003-0000-01')
+    assert (setid, ndcs, int(ndc11)) == ('setid-b', ['0003-0000-01'], 3000001)
+
+
+def test_unknown_ndc(store_without_spl):
+    with pytest.raises(ValueError):
+        get_set_id_from_ndc('9999-9999-99')
@@ -0,0 +1,38 @@
+from helpers.results_store import ResultsStore
+
+SECTIONS = {'51727-6': 'a', '34089-3': 'b', 'products': 'c', '34067-9': 'd'}
+STAGES = {'group1': {'found_ing': ['talc']}, 'group2_3': {'result_ids': []},
+          'group4_5': {'result_ids_g4': [], 'result_ids_g5': []}}
+
+
+def make_store(tmp_path):
+    store = ResultsStore(str(tmp_path / 'results.json'))
+    store.put('setid-1', 'setid-1', 3, [1, 2], sections=SECTIONS, stages=STAGES)
+    return store
+
+
+def test_stages_reused_with_same_configuration(tmp_path, monkeypatch):
+    monkeypatch.setenv('PROMPT_SET', 'set3')
+    store = make_store(tmp_path)
+
+    # only the Group 4-5 input (whole label) changed
+    assert sorted(store.reusable_stages('setid-1', dict(SECTIONS, **{'34067-9': 'e'}), 'setid')) == \
+        ['group1', 'group2_3']
+
+
+def test_stages_not_reused_after_prompt_set_change(tmp_path, monkeypatch):
+    monkeypatch.setenv('PROMPT_SET', 'set3')
+    store = make_store(tmp_path)
+
+    monkeypatch.setenv('PROMPT_SET', 'set4')
+    assert store.reusable_stages('setid-1', SECTIONS, 'setid') == {}
+    assert store.get('setid-1', 3) is None
+
+
+def test_result_not_reused_after_pipeline_change(tmp_path, monkeypatch):
+    monkeypatch.setenv('EXTRACT_METHOD', 'xml')
+    store = make_store(tmp_path)
+    assert store.get('setid-1', 3) is not None
+
+    monkeypatch.setenv('EXTRACT_METHOD', 'pdf')
+    assert store.get('setid-1', 3) is None
@@ -0,0 +1,29 @@
+import os
+import pandas as pd
+from helpers.rules import compile_rules, normalize_route, resolve_group2_3
+
+RULES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'LLM05_GROUP_2-5_RULES.csv')
+
+
+def test_normalize_route():
+    _, known_routes = compile_rules(RULES)
+    assert normalize_route('ORAL', known_routes) == ['oral']
+    assert sorted(normalize_route('INTRAVENOUS, SUBCUTANEOUS', known_routes)) == ['intravenous', 'subcutaneous']
+
+
+def test_unknown_route_is_unresolved():
+    _, known_routes = compile_rules(RULES)
+    assert normalize_route('oral; cutaneous', known_routes) is None
+
+
+def test_unknown_route_left_to_llm():
+    df = pd.read_csv(RULES).fillna("")
+    df_gp2, df_gp3 = df.loc[df.Group == 2], df.loc[df.Group == 3]
+
+    answer, left_gp2, left_gp3 = resolve_group2_3(df_gp2, df_gp3, 'oral; cutaneous', RULES)
+    assert answer == {}
+    assert left_gp2.shape[0] == df_gp2.shape[0] and left_gp3.shape[0] == df_gp3.shape[0]
+
+    # the known route alone is resolved locally
+    answer, _, _ = resolve_group2_3(df_gp2, df_gp3, 'oral', RULES)
+    assert len(answer) > 0